@@ -0,0 +1,203 @@
+# Load standard libraries
+import argparse
+import os
+import shlex
+import time
+from pathlib import Path
+
+# Script commands and the number of words each takes after the command, as (fewest, most)
+commands = {
+    "guild": (1, 1),
+    "create": (2, 2),
+    "add": (3, None),
+    "remove": (3, None),
+    "erase": (1, 1),
+    "delete": (1, 2),
+}
+
+
+# Point the database module at the given file and import it, so only the database chosen on the command line
+# is opened and migrated, and nothing from discord is loaded
+def open_database(path=None, storage=None):
+    if path:
+        os.environ["KEEPER_DATABASE_URL"] = f"sqlite:///{Path(path).resolve()}"
+
+    import database
+
+    if storage:
+        database.configure_storage(storage)
+
+    return database
+
+
+# Read the storage profile from a bot config file so the CLI opens the database the same way the bot does
+def load_storage(path):
+    import yaml
+
+    with open(path) as file:
+        return (yaml.safe_load(file) or {}).get("storage", {})
+
+
+# Turn one script line into an (operation name, arguments) pair for database.apply_batch.
+# Returns the guild for guild lines and None for blank lines and comments.
+def parse_line(line, guild_id, user):
+    words = shlex.split(line, comments=True)
+
+    if not words:
+        return None
+
+    command, arguments = words[0].lower(), words[1:]
+    fewest, most = commands.get(command, (None, None))
+
+    if fewest is None or len(arguments) < fewest or (most is not None and len(arguments) > most):
+        raise ValueError(f"Can't read {line.strip()!r}")
+
+    if command == "guild":
+        return int(arguments[0])
+
+    if not guild_id:
+        raise ValueError(f"No guild given before {line.strip()!r}")
+
+    if command == "create":
+        return "create_character", (guild_id, arguments[0], int(arguments[1]))
+
+    if command in ("add", "remove"):
+        name, currency, amount, *reason = arguments
+        amount = int(amount)
+
+        if amount <= 0 or currency.upper() not in ("AP", "RP"):
+            raise ValueError(f"Can't read {line.strip()!r}")
+
+        return "apply_transaction", (guild_id, name, user, currency.upper(), amount if command == "add" else -amount,
+                                     " ".join(reason))
+
+    if command == "erase":
+        return "erase_transaction", (guild_id, int(arguments[0]))
+
+    if arguments[1:] not in ([], ["archive"]):
+        raise ValueError(f"Can't read {line.strip()!r}")
+
+    return "delete_character", (guild_id, arguments[0], bool(arguments[1:]))
+
+
+# Read a whole script up front so a typo anywhere stops it before anything is written.
+# Returns (line number, operation name, arguments) for every operation.
+def read_script(path, guild_id=None, user=None):
+    operations = []
+
+    with open(path, encoding="utf-8") as file:
+        for number, line in enumerate(file, 1):
+            try:
+                parsed = parse_line(line, guild_id, user)
+            except ValueError as error:
+                raise ValueError(f"Line {number}: {error}")
+
+            if isinstance(parsed, int):
+                guild_id = parsed
+            elif parsed:
+                operations.append((number, *parsed))
+
+    return operations
+
+
+# Whether an operation's result means it did what the script asked
+def succeeded(database, result):
+    return result is True or result == database.TRANSACTION_DONE
+
+
+# Apply operations in batches of batch_size with one commit each, calling progress(done, total) after each.
+# A dry run applies everything in one transaction and rolls it back at the end.
+# Returns the (line number, operation name, result) of every operation that didn't go through.
+def run_script(database, operations, batch_size=5000, dry_run=False, progress=None):
+    failures = []
+
+    try:
+        for start in range(0, len(operations), batch_size):
+            batch = operations[start:start + batch_size]
+            results = database.apply_batch([(operation, arguments) for _, operation, arguments in batch],
+                                           commit=not dry_run)
+
+            if results is None:
+                raise RuntimeError(f"Failed to apply lines {batch[0][0]} to {batch[-1][0]}, "
+                                   + ("nothing was written" if dry_run else "earlier lines were written"))
+
+            failures += [(number, operation, result) for (number, operation, _), result in zip(batch, results)
+                         if not succeeded(database, result)]
+
+            if progress:
+                progress(start + len(batch), len(operations))
+    finally:
+        if dry_run:
+            database.session.rollback()
+
+    return failures
+
+
+# Remove the transactions of every deleted character, chunk by chunk, as the bot would after a restart
+def purge_deletions(database, chunk_size=1000):
+    removed = 0
+
+    for pending in database.get_pending_deletions():
+        while count := database.purge_deleted_transactions(pending.character_id, chunk_size):
+            removed += count
+
+    return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run batch scripts against keeper.db without the discord bot")
+    parser.add_argument("script", nargs="?",
+                        help="File with one create, add, remove, erase, delete or guild command per line")
+    parser.add_argument("--database", help="Database file, keeper.db or KEEPER_DATABASE_URL by default")
+    parser.add_argument("--config", help="Bot config whose storage profile to apply")
+    parser.add_argument("--guild", type=int, help="Guild for commands before the first guild line")
+    parser.add_argument("--user", type=int, help="Discord user id logged on transactions")
+    parser.add_argument("--batch-size", type=int, default=5000, help="Operations per commit")
+    parser.add_argument("--dry-run", action="store_true", help="Apply everything, report the outcome and roll back")
+    parser.add_argument("--repair-counters", action="store_true",
+                        help="Recount every character's transactions and every guild's characters from the ledger, "
+                             "after the script if one is given")
+    args = parser.parse_args()
+
+    if not args.script and not args.repair_counters:
+        parser.error("Give a script, --repair-counters or both")
+
+    if args.repair_counters and args.dry_run:
+        parser.error("--repair-counters commits right away, so it can't be part of a dry run")
+
+    # Check the whole script before opening the database
+    try:
+        operations = read_script(args.script, args.guild, args.user) if args.script else []
+    except ValueError as error:
+        parser.error(str(error))
+
+    database = open_database(args.database, load_storage(args.config) if args.config else None)
+    start = time.monotonic()
+
+    def progress(done, total):
+        print(f"{'Checked' if args.dry_run else 'Applied'} {done}/{total} operations "
+              f"({done / max(time.monotonic() - start, 0.001):.0f}/s)")
+
+    if args.script:
+        failures = run_script(database, operations, args.batch_size, args.dry_run, progress)
+
+        for number, operation, result in failures:
+            print(f"Line {number}: {operation} {'failed' if result is False else result}")
+
+        print(f"{len(operations) - len(failures)} of {len(operations)} operations "
+              + ("would go through" if args.dry_run else "went through"))
+
+    if not args.dry_run:
+        removed = purge_deletions(database)
+
+        if removed:
+            print(f"Removed {removed} transactions of deleted characters")
+
+        if args.repair_counters:
+            print("Repaired the counters" if database.repair_counters() else "Failed to repair the counters")
+
+        print("Use /reload in discord, or restart the bot, so its leaderboards and character names catch up")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# Load standard libraries
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+# Load project files
+import database
+import ledger_io
+
+# Worker threads that run the blocking SQLAlchemy calls off the event loop
+executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="keeper-db")
+
+
+# Run a database function and release its session so every call gets a fresh one
+def _call(func, *args, **kwargs):
+    try:
+        return func(*args, **kwargs)
+    finally:
+        database.session.remove()
+
+
+# Turn a blocking database function into a coroutine that runs in the executor.
+# The caller's context variables come along so work in the thread is attributed to the right interaction.
+def _wrap(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(executor, context.run, functools.partial(_call, func, *args, **kwargs))
+
+    return wrapper
+
+
+create_character = _wrap(database.create_character)
+delete_character = _wrap(database.delete_character)
+purge_deleted_transactions = _wrap(database.purge_deleted_transactions)
+get_pending_deletions = _wrap(database.get_pending_deletions)
+erase_transaction = _wrap(database.erase_transaction)
+apply_transaction = _wrap(database.apply_transaction)
+do_transaction = _wrap(database.do_transaction)
+do_bulk_transaction = _wrap(database.do_bulk_transaction)
+apply_batch = _wrap(database.apply_batch)
+get_character_by_name = _wrap(database.get_character_by_name)
+get_character_by_id = _wrap(database.get_character_by_id)
+get_character_by_transaction_id = _wrap(database.get_character_by_transaction_id)
+get_transaction_by_id = _wrap(database.get_transaction_by_id)
+get_character_standings = _wrap(database.get_character_standings)
+get_characters_by_owner = _wrap(database.get_characters_by_owner)
+get_all_characters = _wrap(database.get_all_characters)
+get_all_character_pages = _wrap(database.get_all_character_pages)
+get_counter = _wrap(database.get_counter)
+repair_counters = _wrap(database.repair_counters)
+get_character_transactions = _wrap(database.get_character_transactions)
+get_character_log = _wrap(database.get_character_log)
+get_characters_to_archive = _wrap(database.get_characters_to_archive)
+archive_character_transactions = _wrap(database.archive_character_transactions)
+get_all_character_transactions = _wrap(database.get_all_character_transactions)
+get_character_transaction_pages = _wrap(database.get_character_transaction_pages)
+get_player_names = _wrap(database.get_player_names)
+save_player_names = _wrap(database.save_player_names)
+get_characters_after = _wrap(database.get_characters_after)
+get_character_transactions_after = _wrap(database.get_character_transactions_after)
+search_transactions = _wrap(database.search_transactions)
+backfill_rollups = _wrap(database.backfill_rollups)
+get_economy = _wrap(database.get_economy)
+get_balance_at = _wrap(database.get_balance_at)
+reconcile_balances = _wrap(database.reconcile_balances)
+
+export_table = _wrap(ledger_io.export_table)
@@ -0,0 +1,335 @@
+# Load standard libraries
+import argparse
+import asyncio
+import datetime
+import importlib
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+# Role id the fake GM context carries, also written into the benchmark config
+gm_role = 1
+
+# Guild the synthetic characters belong to and the fake context runs in
+guild = 1
+
+# Config written next to the database so kindred_keeper can be imported without a real bot token.
+# Repeated writes are the point of the benchmark, so they aren't answered from the idempotency window.
+benchmark_config = """token: "benchmark"
+guild_ids:
+  - 1
+gm_roles:
+  - 1
+character_limit: 1000000
+page_size: 20
+idempotency_window: 0
+"""
+
+
+# Point the database module at the given file and import it, so nothing touches ./keeper.db
+def open_database(path):
+    os.environ["KEEPER_DATABASE_URL"] = f"sqlite:///{Path(path).resolve()}"
+    return importlib.import_module("database")
+
+
+# Draw character indexes with a Zipf-like skew so a few veterans own most of the ledger
+def skewed_characters(characters, skew, rng):
+    weights = [1 / (rank ** skew) for rank in range(1, characters + 1)]
+    rng.shuffle(weights)
+    return lambda count: rng.choices(range(characters), weights=weights, k=count)
+
+
+# Build a synthetic guild database with the given number of characters, players and transactions.
+# Characters go in as one multi-row INSERT and transactions look their characters up with one IN list, so both
+# are chunked to stay under SQLite's limit on bound variables.
+def generate(path, characters, players, transactions, skew, seed, chunk_size=10000, character_chunk_size=1000):
+    if Path(path).exists():
+        Path(path).unlink()
+
+    database = open_database(path)
+    rng = random.Random(seed)
+    start = time.perf_counter()
+
+    for offset in range(0, characters, character_chunk_size):
+        end = min(offset + character_chunk_size, characters)
+        rows = [{"guild_id": guild, "name": f"Character {index}", "player": rng.randrange(players) + 1000,
+                 "ap": 0, "rp": 0} for index in range(offset, end)]
+
+        if database.import_characters(rows) is False:
+            raise RuntimeError(f"Failed to import characters {offset} to {end - 1}")
+
+    pick = skewed_characters(characters, skew, rng)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    done = 0
+
+    while done < transactions:
+        count = min(chunk_size, transactions - done)
+        rows = [{"guild_id": guild, "character": f"Character {index}", "currency": rng.choice(["AP", "RP"]),
+                 "amount": rng.randint(1, 20), "user": rng.randrange(players) + 1000,
+                 "reason": f"Session reward {rng.randrange(1000)}",
+                 "date": now - datetime.timedelta(seconds=rng.randrange(365 * 86400))} for index in pick(count)]
+
+        if database.import_transactions(rows) is False:
+            raise RuntimeError(f"Failed to import transactions {done} to {done + count - 1}")
+
+        done += count
+        print(f"Generated {done}/{transactions} transactions", file=sys.stderr)
+
+    print(f"Generated {path} in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+
+# Summarise a list of latencies in seconds as p50/p99 in milliseconds and throughput in operations per second
+def summarise(latencies, elapsed):
+    ordered = sorted(latencies)
+    return {
+        "count": len(ordered),
+        "p50_ms": statistics.median(ordered) * 1000,
+        "p99_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000,
+        "mean_ms": statistics.fmean(ordered) * 1000,
+        "throughput": len(ordered) / elapsed if elapsed else 0,
+    }
+
+
+# Time a function over the given argument tuples
+def time_calls(function, arguments):
+    latencies = []
+    start = time.perf_counter()
+
+    for args in arguments:
+        call_start = time.perf_counter()
+        function(*args)
+        latencies.append(time.perf_counter() - call_start)
+
+    return summarise(latencies, time.perf_counter() - start)
+
+
+# Micro-benchmarks for each database query function
+def run_queries(database, iterations, rng):
+    names = [row.name for row in database.get_character_standings()]
+    players = list({row.player for row in database.get_character_standings()})
+    page_size = 20
+    pages = max(1, database.get_all_character_pages(guild, page_size))
+    heavy = max(names, key=lambda name: database.get_character_by_name(guild, name).transaction_count)
+    heavy_pages = max(1, database.get_character_transaction_pages(guild, heavy, page_size))
+    sample = lambda: rng.choice(names)
+    results = {}
+
+    def record(name, function, arguments):
+        database.reset_page_cursors()
+        results[name] = time_calls(function, arguments)
+        print(f"{name}: p50 {results[name]['p50_ms']:.3f}ms p99 {results[name]['p99_ms']:.3f}ms", file=sys.stderr)
+
+    record("get_character_by_name", database.get_character_by_name, [(guild, sample()) for _ in range(iterations)])
+    record("get_characters_by_owner", database.get_characters_by_owner,
+           [(guild, rng.choice(players)) for _ in range(iterations)])
+    record("get_all_character_pages", database.get_all_character_pages, [(guild, page_size)] * iterations)
+
+    for currency in ["AP", "RP", None]:
+        record(f"get_all_characters {currency or 'name'} first page", database.get_all_characters,
+               [(guild, 1, page_size, currency)] * iterations)
+        record(f"get_all_characters {currency or 'name'} random page", database.get_all_characters,
+               [(guild, rng.randint(1, pages), page_size, currency) for _ in range(iterations)])
+
+    record("get_character_transactions first page", database.get_character_transactions,
+           [(guild, sample(), 1, page_size) for _ in range(iterations)])
+    record("get_character_transactions deepest page", database.get_character_transactions,
+           [(guild, heavy, heavy_pages, page_size)] * iterations)
+    record("get_character_transaction_pages", database.get_character_transaction_pages,
+           [(guild, sample(), page_size) for _ in range(iterations)])
+    record("do_transaction", database.do_transaction,
+           [(guild, sample(), 1, rng.choice(["AP", "RP"]), 1, "Benchmark") for _ in range(iterations)])
+    record("apply_transaction debit", database.apply_transaction,
+           [(guild, sample(), 1, rng.choice(["AP", "RP"]), -1, "Benchmark") for _ in range(iterations)])
+
+    transactions = [transaction.id for transaction in database.get_character_transactions(guild, heavy, 1, iterations)]
+    record("erase_transaction", database.erase_transaction, [(guild, transaction) for transaction in transactions])
+
+    created = [f"Benchmark {index}" for index in range(iterations)]
+    record("create_character", database.create_character, [(guild, name, 1) for name in created])
+    record("delete_character", database.delete_character, [(guild, name) for name in created])
+
+    # Deleting a character only queues its history, so time the chunked purge along with it
+    def delete_with_history(name):
+        character_id = database.get_character_by_name(guild, name).id
+        database.delete_character(guild, name)
+
+        while database.purge_deleted_transactions(character_id):
+            pass
+
+    deletions = max(1, iterations // 50)
+    victims = sorted(names, key=lambda name: -database.get_character_by_name(guild, name).transaction_count)[:deletions]
+    record("delete_character with history", delete_with_history, [(name,) for name in victims])
+    return results
+
+
+# Stand-in for a discord role
+class FakeRole:
+    def __init__(self, role_id):
+        self.id = role_id
+
+
+# Stand-in for the slash command context, recording what the bot responds with
+class FakeContext:
+    def __init__(self, user_id, gm=False):
+        self.author = SimpleNamespace(id=user_id, roles=[FakeRole(gm_role)] if gm else [])
+        self.interaction = SimpleNamespace(user=self.author, guild_id=guild)
+        self.guild = None
+        self.guild_id = guild
+        self.responses = []
+
+    async def respond(self, *args, **kwargs):
+        self.responses.append(args[0] if args else kwargs.get("content"))
+
+    async def defer(self, *args, **kwargs):
+        pass
+
+
+# End-to-end benchmarks that drive the slash command coroutines with a fake context and stubbed discord API
+def run_commands(database_path, iterations, concurrency, fetch_latency, rng):
+    os.chdir(Path(database_path).resolve().parent)
+    Path("config.yml").write_text(benchmark_config)
+    open_database(database_path)
+    keeper = importlib.import_module("kindred_keeper")
+    database = importlib.import_module("database")
+    fetches = []
+
+    async def fetch_user(user_id):
+        fetches.append(user_id)
+        await asyncio.sleep(fetch_latency)
+        return SimpleNamespace(id=user_id, name=f"User {user_id}")
+
+    keeper.bot.fetch_user = fetch_user
+    keeper.bot.get_user = lambda user_id: None
+
+    standings = database.get_character_standings()
+    names = [row.name for row in standings]
+    owners = {row.name: row.player for row in standings}
+    pages = max(1, database.get_all_character_pages(guild, 20))
+
+    commands = {
+        "info": lambda: (keeper.info, FakeContext(1), rng.choice(names), None),
+        "log": lambda: (keeper.log, FakeContext(1), rng.choice(names), rng.randint(1, 3)),
+        "leaderboard": lambda: (keeper.leaderboard, FakeContext(1), rng.randint(1, pages),
+                                rng.choice(["AP", "RP", None])),
+        "rank": lambda: (keeper.rank, FakeContext(1), rng.choice(names), rng.choice(["AP", "RP", None])),
+        "list": lambda: (keeper.list_chars, FakeContext(rng.choice(list(owners.values()))), None),
+        "add": lambda: (keeper.add, FakeContext(1, gm=True), rng.choice(names), "AP", 1, "Benchmark"),
+        "buy": lambda: (lambda name: (keeper.buy, FakeContext(owners[name]), name, "AP", 1, "Benchmark"))(
+            rng.choice(names)),
+    }
+
+    async def timed(command, ctx, *args):
+        start = time.perf_counter()
+        await command.callback(ctx, *args)
+        return time.perf_counter() - start
+
+    async def run(name, factory):
+        keeper.names.cache.clear()
+        fetches.clear()
+        latencies = []
+        start = time.perf_counter()
+
+        for offset in range(0, iterations, concurrency):
+            calls = [factory() for _ in range(min(concurrency, iterations - offset))]
+            latencies += await asyncio.gather(*[timed(*call) for call in calls])
+
+        result = summarise(latencies, time.perf_counter() - start)
+        result["fetch_user_calls"] = len(fetches)
+        print(f"/{name}: p50 {result['p50_ms']:.3f}ms p99 {result['p99_ms']:.3f}ms "
+              f"{result['throughput']:.1f}/s", file=sys.stderr)
+        return result
+
+    async def run_all():
+        return {name: await run(name, factory) for name, factory in commands.items()}
+
+    return asyncio.run(run_all())
+
+
+# Current git commit of the checkout, if there is one
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).parent).stdout.strip() or None
+    except OSError:
+        return None
+
+
+# Print how each benchmark moved between two result files
+def compare(old_path, new_path):
+    old = json.loads(Path(old_path).read_text())
+    new = json.loads(Path(new_path).read_text())
+
+    for suite in ["queries", "commands"]:
+        for name, result in new.get(suite, {}).items():
+            before = old.get(suite, {}).get(name)
+
+            if before:
+                print(f"{suite} {name}: p50 {before['p50_ms']:.3f} -> {result['p50_ms']:.3f}ms, "
+                      f"p99 {before['p99_ms']:.3f} -> {result['p99_ms']:.3f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark keeper.db queries and slash commands")
+    actions = parser.add_subparsers(dest="action", required=True)
+
+    generate_parser = actions.add_parser("generate", help="Build a synthetic guild database")
+    generate_parser.add_argument("path")
+    generate_parser.add_argument("--characters", type=int, default=10000)
+    generate_parser.add_argument("--players", type=int, default=2000)
+    generate_parser.add_argument("--transactions", type=int, default=1000000)
+    generate_parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent of per-character history")
+    generate_parser.add_argument("--seed", type=int, default=0)
+
+    run_parser = actions.add_parser("run", help="Benchmark a copy of a generated database")
+    run_parser.add_argument("path")
+    run_parser.add_argument("--output", default="benchmark.json")
+    run_parser.add_argument("--iterations", type=int, default=500)
+    run_parser.add_argument("--concurrency", type=int, default=10)
+    run_parser.add_argument("--fetch-latency", type=float, default=0.05,
+                            help="Seconds the stubbed fetch_user waits, like a REST round trip")
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--skip-commands", action="store_true")
+
+    compare_parser = actions.add_parser("compare", help="Compare two benchmark result files")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+
+    args = parser.parse_args()
+    sys.path.insert(0, str(Path(__file__).parent))
+
+    if args.action == "generate":
+        generate(args.path, args.characters, args.players, args.transactions, args.skew, args.seed)
+    elif args.action == "compare":
+        compare(args.old, args.new)
+    else:
+        # Benchmarks write to the database, so they run on a copy to keep the generated file reusable
+        output = Path(args.output).resolve()
+        directory = tempfile.mkdtemp(prefix="keeper-benchmark-")
+        copy = Path(directory) / "keeper.db"
+        copy.write_bytes(Path(args.path).read_bytes())
+        rng = random.Random(args.seed)
+
+        results = {
+            "commit": git_commit(),
+            "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "database": str(args.path),
+            "iterations": args.iterations,
+            "queries": run_queries(open_database(copy), args.iterations, rng),
+        }
+
+        if not args.skip_commands:
+            results["commands"] = run_commands(copy, args.iterations, args.concurrency, args.fetch_latency, rng)
+
+        output.write_text(json.dumps(results, indent=2))
+        print(f"Saved results to {output}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+# Load standard libraries
+import asyncio
+import contextvars
+import functools
+import time
+
+# Seconds a finished write command is remembered, so a repeat of it is answered with the first result
+idempotency_window = 10
+
+# Seconds a request waits on an identical one before deferring, so its interaction doesn't expire
+defer_after = 2
+
+in_flight = {}
+finished = {}
+
+# Recording context of the shared run the current task belongs to
+current_run = contextvars.ContextVar("current_run", default=None)
+
+
+# Context passed to a shared command run that records its responses while sending them
+class RecordingContext:
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.responses = []
+        self.committed = False
+
+    def __getattr__(self, name):
+        return getattr(self.ctx, name)
+
+    async def respond(self, *args, **kwargs):
+        self.responses.append((args, kwargs))
+        return await self.ctx.respond(*args, **kwargs)
+
+
+# Send recorded responses again on another interaction. Paged views are cloned so each message keeps its own
+# page while sharing the rendered pages.
+async def replay(ctx, responses):
+    for args, kwargs in responses:
+        view = kwargs.get("view")
+
+        if view is not None and hasattr(view, "clone"):
+            kwargs = {**kwargs, "view": view.clone()}
+
+        await ctx.respond(*args, **kwargs)
+
+
+# Wait for a shared run, deferring the interaction if it takes long
+async def wait_for(ctx, task):
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), defer_after)
+    except asyncio.TimeoutError:
+        await ctx.defer()
+        return await task
+
+
+# Forget finished writes older than the idempotency window
+def expire_finished():
+    now = time.monotonic()
+
+    for key in [key for key, (_, done) in finished.items() if now - done > idempotency_window]:
+        del finished[key]
+
+
+# Mark the running command as having written something. Only such runs are remembered for the idempotency window,
+# so a retry after a refusal or failure runs again instead of getting the stale answer.
+def committed():
+    recording = current_run.get()
+
+    if recording is not None:
+        recording.committed = True
+
+
+# Run a command once for every identical request made while it runs, or within the idempotency window after it
+# finished if remember is set and the run committed, and answer the others with the same responses
+async def run_shared(key, function, ctx, args, kwargs, remember):
+    expire_finished()
+
+    if key in finished:
+        await replay(ctx, finished[key][0])
+        return
+
+    if key in in_flight:
+        await replay(ctx, await wait_for(ctx, in_flight[key]))
+        return
+
+    recording = RecordingContext(ctx)
+
+    async def run():
+        current_run.set(recording)
+        await function(recording, *args, **kwargs)
+        return recording.responses
+
+    task = asyncio.ensure_future(run())
+    in_flight[key] = task
+
+    try:
+        responses = await task
+    finally:
+        del in_flight[key]
+
+    if remember and recording.committed:
+        finished[key] = (responses, time.monotonic())
+
+
+# Share one run of a read command between identical requests in the same guild that arrive while it runs.
+# With per_user the requests must also come from the same user.
+def shared_read(per_user=False):
+    def decorator(function):
+        @functools.wraps(function)
+        async def wrapper(ctx, *args, **kwargs):
+            key = (function.__name__, ctx.guild_id, ctx.author.id if per_user else None, args,
+                   tuple(sorted(kwargs.items())))
+            await run_shared(key, function, ctx, args, kwargs, False)
+
+        return wrapper
+
+    return decorator
+
+
+# Answer a repeat of a write command by the same user with the same arguments, while it runs or within the
+# idempotency window after a run that called committed(), with the first run's responses instead of writing again.
+# A window of 0 turns this off.
+def idempotent(function):
+    @functools.wraps(function)
+    async def wrapper(ctx, *args, **kwargs):
+        if not idempotency_window:
+            return await function(ctx, *args, **kwargs)
+
+        key = (function.__name__, ctx.guild_id, ctx.author.id, args, tuple(sorted(kwargs.items())))
+        await run_shared(key, function, ctx, args, kwargs, True)
+
+    return wrapper
@@ -1,34 +1,84 @@
 from sqlalchemy import create_engine, values
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import scoped_session, sessionmaker, Session
 from sqlalchemy.orm import declarative_base
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import Column, Integer, String, Date, DateTime, Index, Boolean, LargeBinary
 from sqlalchemy import ForeignKey
 from sqlalchemy import select
 from sqlalchemy.orm import relationship
 from sqlalchemy import desc
 import datetime
+import json
 from sqlalchemy import func
+from sqlalchemy import and_, or_, tuple_
+from sqlalchemy import inspect, insert, text, update, bindparam, delete, literal, cast, MetaData, table, column, case
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy import event
 import math
+import os
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
 
 
 # Create a SQLite database in memory for testing
-engine = create_engine(f"sqlite:///keeper.db")
+# KEEPER_DATABASE_URL points tools such as the benchmarks at another database file
+engine = create_engine(os.environ.get("KEEPER_DATABASE_URL", f"sqlite:///keeper.db"))
+
+# Pool of query-only connections for reads, set up by configure_storage
+read_engine = None
+
+# Storage profile settings and the PRAGMA each one sets, with the values each accepts
+storage_pragmas = {
+    "journal_mode": ("journal_mode", ["DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"]),
+    "synchronous": ("synchronous", ["OFF", "NORMAL", "FULL", "EXTRA"]),
+    "mmap_size": ("mmap_size", int),
+    "cache_size": ("cache_size", int),
+    "temp_store": ("temp_store", ["DEFAULT", "FILE", "MEMORY"]),
+    "busy_timeout": ("busy_timeout", int),
+}
+
+
+# Session that sends reads to the reader pool, and everything from the first write until the end of the
+# transaction to the writer so a unit of work always reads its own changes. The session is marked as writing
+# from the first write on even without a reader pool, since the character cache relies on it.
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or self.info.get("writing") or getattr(clause, "is_dml", False):
+            self.info["writing"] = True
+            return engine
+
+        return engine if read_engine is None else read_engine
+
+
+@event.listens_for(RoutingSession, "after_transaction_end")
+def end_writing(routing_session, transaction):
+    if transaction.parent is None:
+        routing_session.info.pop("writing", None)
+
 
 # Define base for model classes
 Base = declarative_base()
 
-# Create a session
-session = Session(engine)
+# Create a thread-local session registry so each worker thread gets its own unit of work.
+# Objects stay readable after commit because callers use them after the session is released.
+session = scoped_session(sessionmaker(engine, class_=RoutingSession, expire_on_commit=False))
 
 # Character database object
 class Character(Base):
     __tablename__ = 'character'
 
+    # Ids are never reused, so a new character can't inherit the transactions of a deleted one still being purged
+    __table_args__ = {"sqlite_autoincrement": True}
+
     id = Column(Integer, primary_key=True)
-    name = Column(String(100), unique=True)
+    guild_id = Column(Integer, default=0)
+    name = Column(String(100))
     ap = Column(Integer, default=0)
     rp = Column(Integer, default=0)
     player = Column(Integer)
+    transaction_count = Column(Integer, default=0)
 
     transactions = relationship('Transaction', cascade="all, delete",
                                 passive_deletes=True)
@@ -39,6 +89,7 @@ class Transaction(Base):
     __tablename__ = 'transaction'
 
     id = Column(Integer, primary_key=True)
+    guild_id = Column(Integer, default=0)
     character_id = Column(Integer, ForeignKey('character.id', ondelete='CASCADE'))
     amount = Column(Integer)
     currency = Column(String())
@@ -47,178 +98,1443 @@ class Transaction(Base):
     date = Column(DateTime)
 
 
-# If the tables don't exist, create them
-Base.metadata.create_all(engine)
+# Last known discord name of a player or GM, so cold starts don't refetch everyone
+class PlayerName(Base):
+    __tablename__ = 'player_name'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(100))
+    updated = Column(DateTime)
+
+
+# Compressed block of a character's old transactions moved out of the transaction table, newest first
+class TransactionArchive(Base):
+    __tablename__ = 'transaction_archive'
+
+    id = Column(Integer, primary_key=True)
+    character_id = Column(Integer)
+    count = Column(Integer)
+    first_date = Column(DateTime)
+    last_date = Column(DateTime)
+    last_transaction_id = Column(Integer)
+    data = Column(LargeBinary)
+
+
+# Deleted character whose transactions are still being removed in chunks
+class PendingDeletion(Base):
+    __tablename__ = 'pending_deletion'
+
+    character_id = Column(Integer, primary_key=True)
+    name = Column(String(100))
+    archive = Column(Boolean, default=False)
+    total = Column(Integer)
+    date = Column(DateTime)
+
+
+# Transaction of a deleted character, kept when the character was deleted with archiving
+class DeletedTransaction(Base):
+    __tablename__ = 'deleted_transaction'
+
+    id = Column(Integer, primary_key=True)
+    character_id = Column(Integer)
+    character_name = Column(String(100))
+    amount = Column(Integer)
+    currency = Column(String())
+    user = Column(Integer)
+    reason = Column(String(100))
+    date = Column(DateTime)
+    deleted = Column(DateTime)
+
+
+# Currency that flowed in and out of a guild per day, character, logging user and currency, kept up to date as
+# transactions are logged and erased so economy reports never read the ledger itself
+class DailyRollup(Base):
+    __tablename__ = 'daily_rollup'
+
+    guild_id = Column(Integer, primary_key=True)
+    day = Column(Date, primary_key=True)
+    character_id = Column(Integer, primary_key=True)
+    user = Column(Integer, primary_key=True)
+    currency = Column(String(2), primary_key=True)
+    inflow = Column(Integer, default=0)
+    outflow = Column(Integer, default=0)
+    count = Column(Integer, default=0)
+
+
+# A character's balances and transaction count from every transaction dated before the boundary, written every
+# checkpoint_every transactions so a past balance or a reconciliation only needs the transactions after one
+class BalanceCheckpoint(Base):
+    __tablename__ = 'balance_checkpoint'
+
+    character_id = Column(Integer, primary_key=True)
+    boundary = Column(DateTime, primary_key=True)
+    ap = Column(Integer, default=0)
+    rp = Column(Integer, default=0)
+    count = Column(Integer, default=0)
+
+
+# Transactions of a character between two balance checkpoints
+checkpoint_every = 100
+
+
+# Named running totals, such as the number of characters, kept so page counts don't need COUNT queries
+class Counter(Base):
+    __tablename__ = 'counter'
+
+    name = Column(String(50), primary_key=True)
+    value = Column(Integer, default=0)
+
+
+# Applied schema migrations, one row per version
+class SchemaVersion(Base):
+    __tablename__ = 'schema_version'
+
+    version = Column(Integer, primary_key=True)
+    description = Column(String(100))
+    applied = Column(DateTime)
+
+
+# Indexes backing the lookups, leaderboard orderings and transaction log. Character indexes lead with the
+# guild so each guild's queries only touch that guild's rows.
+query_indexes = [
+    Index('ux_character_guild_name', Character.guild_id, Character.name, unique=True),
+    Index('ix_character_guild_player', Character.guild_id, Character.player),
+    Index('ix_character_guild_lower_name', Character.guild_id, func.lower(Character.name)),
+    Index('ix_character_guild_ap', Character.guild_id, Character.ap.desc(), func.lower(Character.name), Character.id),
+    Index('ix_character_guild_rp', Character.guild_id, Character.rp.desc(), func.lower(Character.name), Character.id),
+    Index('ix_transaction_character_date', Transaction.character_id, Transaction.date.desc(), Transaction.id.desc()),
+    Index('ix_transaction_date', Transaction.date),
+    Index('ix_transaction_guild_date', Transaction.guild_id, Transaction.date),
+    Index('ix_transaction_archive_character', TransactionArchive.character_id, TransactionArchive.last_date.desc(),
+          TransactionArchive.last_transaction_id.desc()),
+]
+
+
+# Get the column names of a table
+def table_columns(connection, table):
+    return [column[1] for column in connection.execute(text(f'PRAGMA table_info("{table}")'))]
+
+
+# Full-text index over transaction reasons. The guild, character, user and currency are indexed too, so a search
+# only walks matches that pass its filters, and they carry no weight in the ranking. The transaction table holds
+# the text and triggers keep the index in step with every insert, delete and change, whichever code path
+# makes them.
+search_statements = [
+    """CREATE VIRTUAL TABLE transaction_search USING fts5(
+        reason, guild_id, character_id, user, currency, content='transaction', content_rowid='id', prefix='2 3')""",
+    "INSERT INTO transaction_search(transaction_search, rank) VALUES ('rank', 'bm25(1.0, 0.0, 0.0, 0.0, 0.0)')",
+    """CREATE TRIGGER transaction_search_insert AFTER INSERT ON "transaction" BEGIN
+        INSERT INTO transaction_search(rowid, reason, guild_id, character_id, user, currency)
+            VALUES (new.id, new.reason, new.guild_id, new.character_id, new.user, new.currency);
+    END""",
+    """CREATE TRIGGER transaction_search_delete AFTER DELETE ON "transaction" BEGIN
+        INSERT INTO transaction_search(transaction_search, rowid, reason, guild_id, character_id, user, currency)
+            VALUES ('delete', old.id, old.reason, old.guild_id, old.character_id, old.user, old.currency);
+    END""",
+    """CREATE TRIGGER transaction_search_update AFTER UPDATE ON "transaction" BEGIN
+        INSERT INTO transaction_search(transaction_search, rowid, reason, guild_id, character_id, user, currency)
+            VALUES ('delete', old.id, old.reason, old.guild_id, old.character_id, old.user, old.currency);
+        INSERT INTO transaction_search(rowid, reason, guild_id, character_id, user, currency)
+            VALUES (new.id, new.reason, new.guild_id, new.character_id, new.user, new.currency);
+    END""",
+]
+
+# Most recent matches a search ranks, so a word in nearly every reason can't make it walk the whole ledger
+max_search_matches = 10000
+
+# The full-text index as a lightweight table for building queries, where the column named after the table
+# is the one MATCH runs against
+transaction_search = table("transaction_search", column("rowid"), column("rank"), column("transaction_search"))
+
+
+# Create the full-text index alongside the transaction table in a fresh database
+@event.listens_for(Transaction.__table__, "after_create")
+def create_transaction_search(target, connection, **kwargs):
+    for statement in search_statements:
+        connection.execute(text(statement))
+
+
+# Add the full-text index to an existing database and fill it from the transactions already there
+def migrate_add_transaction_search(connection):
+    create_transaction_search(Transaction.__table__, connection)
+    connection.execute(text("INSERT INTO transaction_search(transaction_search) VALUES ('rebuild')"))
+
+
+# Add the query indexes to databases created before they existed, leaving out those on columns that a later
+# migration adds
+def migrate_add_query_indexes(connection):
+    existing = set(connection.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'")).scalars())
+    columns = {}
+
+    for index in query_indexes:
+        available = columns.setdefault(index.table.name, table_columns(connection, index.table.name))
+
+        if index.name not in existing and all(column.name in available for column in index.columns):
+            index.create(connection)
+
+
+# Add the per-character transaction count and fill in the counters. Characters have no guild yet at this version,
+# so they get one plain count that migrate_partition_by_guild replaces with per-guild counts.
+def migrate_add_counters(connection):
+    if "transaction_count" not in table_columns(connection, "character"):
+        connection.execute(text("ALTER TABLE character ADD COLUMN transaction_count INTEGER DEFAULT 0"))
+
+    connection.execute(text('UPDATE character SET transaction_count = '
+                            '(SELECT count(*) FROM "transaction" WHERE "transaction".character_id = character.id)'))
+    connection.execute(text("INSERT OR REPLACE INTO counter (name, value) "
+                            "SELECT 'characters', count(*) FROM character"))
+
+
+# Rebuild the character table with the current definition, copying the given columns from the old one
+def rebuild_character_table(connection, columns):
+    table = Character.__table__.to_metadata(MetaData(), name="character_new")
+    table.indexes.clear()
+    table.create(connection)
+    connection.execute(text("INSERT INTO character_new (id, guild_id, name, ap, rp, player, transaction_count) "
+                            f"SELECT {columns} FROM character"))
+    connection.execute(text("DROP TABLE character"))
+    connection.execute(text("ALTER TABLE character_new RENAME TO character"))
+
+
+# Give characters and transactions a guild, with names unique per guild instead of across every guild.
+# Existing rows get guild 0 until claim_unassigned hands them to a guild.
+def migrate_partition_by_guild(connection):
+    if "guild_id" not in table_columns(connection, "character"):
+        # SQLite can't drop the old unique constraint on name, so the table is rebuilt without it
+        rebuild_character_table(connection, "id, 0, name, ap, rp, player, transaction_count")
+
+    if "guild_id" not in table_columns(connection, "transaction"):
+        connection.execute(text('ALTER TABLE "transaction" ADD COLUMN guild_id INTEGER DEFAULT 0'))
+
+    migrate_add_query_indexes(connection)
+    recount(connection)
+
+
+# Fill the daily rollups from the ledger already there
+def migrate_add_rollups(connection):
+    rebuild_rollups(connection)
+
+
+# Checkpoint every existing character at its current balances, which later reconciliations check against
+def migrate_add_checkpoints(connection):
+    connection.execute(insert(BalanceCheckpoint).from_select(
+        ["character_id", "boundary", "ap", "rp", "count"],
+        select(Character.id, literal(datetime.datetime.now(datetime.timezone.utc), DateTime), Character.ap,
+               Character.rp, Character.transaction_count)))
+
+
+# Let SQLite hand out character ids with AUTOINCREMENT, starting above every id in use or still being purged
+def migrate_autoincrement_characters(connection):
+    definition = connection.execute(text(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'character'")).scalar()
+
+    if "AUTOINCREMENT" not in definition.upper():
+        rebuild_character_table(connection, "id, guild_id, name, ap, rp, player, transaction_count")
+        migrate_add_query_indexes(connection)
+
+    connection.execute(text("DELETE FROM sqlite_sequence WHERE name = 'character'"))
+    connection.execute(text("INSERT INTO sqlite_sequence (name, seq) SELECT 'character', max("
+                            "coalesce((SELECT max(id) FROM character), 0), "
+                            "coalesce((SELECT max(character_id) FROM pending_deletion), 0))"))
+
+
+# Schema migrations in order as (version, description, function taking a connection)
+migrations = [
+    (1, "Add query indexes", migrate_add_query_indexes),
+    (2, "Add transaction and character counters", migrate_add_counters),
+    (3, "Add transaction archive index", migrate_add_query_indexes),
+    (4, "Partition characters and transactions by guild", migrate_partition_by_guild),
+    (5, "Add full-text search over transaction reasons", migrate_add_transaction_search),
+    (6, "Add daily economy rollups", migrate_add_rollups),
+    (7, "Add balance checkpoints", migrate_add_checkpoints),
+    (8, "Never reuse character ids", migrate_autoincrement_characters),
+]
+
+
+# Add to a named counter, creating it if needed
+def change_counter(executor, name, delta):
+    executor.execute(sqlite_insert(Counter).values(name=name, value=delta).on_conflict_do_update(
+        index_elements=[Counter.name], set_={"value": Counter.value + delta}))
+
+
+# Name of the counter holding a guild's number of characters
+def character_counter(guild_id):
+    return f"characters:{guild_id}"
+
+
+# Recompute every counter from the underlying tables. Archived transactions still count towards their character.
+def recount(executor):
+    executor.execute(update(Character).values(transaction_count=select(func.count(Transaction.id)).where(
+        Transaction.character_id == Character.id).scalar_subquery() + select(
+        func.coalesce(func.sum(TransactionArchive.count), 0)).where(
+        TransactionArchive.character_id == Character.id).scalar_subquery()))
+    executor.execute(delete(Counter).where(Counter.name.like("characters%")))
+    executor.execute(insert(Counter).from_select(["name", "value"], select(
+        literal("characters:") + cast(Character.guild_id, String), func.count(Character.id)).group_by(
+        Character.guild_id)))
+
+
+# Upsert adding to the daily rollups. It is built once and runs on the plain table, since building it and
+# going through the ORM's bulk persistence each time cost far more than the upsert itself.
+rollup_insert = sqlite_insert(DailyRollup.__table__)
+rollup_upsert = rollup_insert.on_conflict_do_update(
+    index_elements=[DailyRollup.guild_id, DailyRollup.day, DailyRollup.character_id, DailyRollup.user,
+                    DailyRollup.currency],
+    set_={"inflow": DailyRollup.inflow + rollup_insert.excluded.inflow,
+          "outflow": DailyRollup.outflow + rollup_insert.excluded.outflow,
+          "count": DailyRollup.count + rollup_insert.excluded.count})
+
+
+# Add transactions, given as dicts of guild_id, character_id, user, currency, amount and date, to the daily
+# rollups, or take them back out with a sign of -1
+def roll_up(executor, transactions, sign=1):
+    totals = {}
+
+    for transaction in transactions:
+        day = transaction["date"].date()
+        user = transaction["user"] or 0
+        key = (transaction["guild_id"], day, transaction["character_id"], user, transaction["currency"])
+        total = totals.setdefault(key, {"guild_id": key[0], "day": day, "character_id": key[2], "user": user,
+                                        "currency": key[4], "inflow": 0, "outflow": 0, "count": 0})
+        total["inflow" if transaction["amount"] >= 0 else "outflow"] += sign * abs(transaction["amount"])
+        total["count"] += sign
+
+    if totals:
+        executor.execute(rollup_upsert, list(totals.values()))
+
+
+# Turn an archive block back into transient Transaction objects, newest first
+def unpack_archive(block):
+    return [Transaction(id=row[0], character_id=block.character_id, amount=row[1], currency=row[2], user=row[3],
+                        reason=row[4], date=datetime.datetime.fromisoformat(row[5]))
+            for row in json.loads(zlib.decompress(block.data))]
+
+
+# Recompute the daily rollups of one guild, or every guild, from the transactions and the archive
+def rebuild_rollups(executor, guild_id=None):
+    transactions = select(
+        Transaction.guild_id, func.date(Transaction.date), Transaction.character_id,
+        func.coalesce(Transaction.user, 0), Transaction.currency,
+        func.sum(case((Transaction.amount > 0, Transaction.amount), else_=0)),
+        func.sum(case((Transaction.amount < 0, -Transaction.amount), else_=0)), func.count()).group_by(
+        Transaction.guild_id, func.date(Transaction.date), Transaction.character_id,
+        func.coalesce(Transaction.user, 0), Transaction.currency)
+    blocks = select(TransactionArchive.id).join(Character, Character.id == TransactionArchive.character_id)
+
+    if guild_id is None:
+        executor.execute(delete(DailyRollup))
+    else:
+        executor.execute(delete(DailyRollup).where(DailyRollup.guild_id == guild_id))
+        transactions = transactions.where(Transaction.guild_id == guild_id)
+        blocks = blocks.where(Character.guild_id == guild_id)
+
+    executor.execute(insert(DailyRollup).from_select(
+        ["guild_id", "day", "character_id", "user", "currency", "inflow", "outflow", "count"], transactions))
+
+    # Archive blocks are unpacked one at a time and rolled up in batches so the whole archive is never in memory
+    archived = []
+
+    for block_id in executor.execute(blocks).scalars().all():
+        block = executor.execute(select(TransactionArchive.character_id, TransactionArchive.data,
+                                        Character.guild_id).join(
+            Character, Character.id == TransactionArchive.character_id).where(
+            TransactionArchive.id == block_id)).first()
+        archived += [{"guild_id": block.guild_id, "character_id": block.character_id, "user": transaction.user,
+                      "currency": transaction.currency, "amount": transaction.amount, "date": transaction.date}
+                     for transaction in unpack_archive(block)]
+
+        if len(archived) >= 10000:
+            roll_up(executor, archived)
+            archived = []
+
+    roll_up(executor, archived)
+
+
+# Checkpoint the balances characters had just before a transaction, for those it made a multiple of
+# checkpoint_every, given their rows as updated by it
+def checkpoint_before(executor, characters, currency, amount, date):
+    checkpoints = [{"character_id": character.id, "boundary": date,
+                    "ap": character.ap - (amount if currency == "AP" else 0),
+                    "rp": character.rp - (amount if currency == "RP" else 0),
+                    "count": character.transaction_count - 1}
+                   for character in characters if character.transaction_count % checkpoint_every == 0]
+
+    if checkpoints:
+        executor.execute(sqlite_insert(BalanceCheckpoint).on_conflict_do_nothing(), checkpoints)
+
+
+# Apply transactions added or removed in the past, given as dicts of character_id, date, ap, rp and count changes,
+# to the checkpoints after them
+def shift_checkpoints(executor, changes):
+    if changes:
+        table = BalanceCheckpoint.__table__
+        executor.execute(update(table).where(
+            table.c.character_id == bindparam("s_character_id"), table.c.boundary > bindparam("s_date")).values(
+            ap=table.c.ap + bindparam("s_ap"), rp=table.c.rp + bindparam("s_rp"),
+            count=table.c.count + bindparam("s_count")), [{"s_" + key: value for key, value in change.items()}
+                                                          for change in changes])
+
+
+# Record a migration as applied
+def stamp_migration(connection, version, description):
+    connection.execute(insert(SchemaVersion).values(
+        version=version, description=description, applied=datetime.datetime.now(datetime.timezone.utc)))
+
+
+# Create missing tables and bring an existing database up to the latest schema version
+def run_migrations():
+    fresh = not inspect(engine).has_table(Character.__tablename__)
+
+    # If the tables don't exist, create them
+    Base.metadata.create_all(engine)
+
+    with engine.begin() as connection:
+        current = connection.execute(select(func.max(SchemaVersion.version))).scalar() or 0
+
+        for version, description, migration in migrations:
+            if version <= current:
+                continue
+
+            # A fresh database already has the latest schema from create_all
+            if not fresh:
+                migration(connection)
+
+            stamp_migration(connection, version, description)
+
+
+run_migrations()
+
+# Build the PRAGMA statements for a storage profile, rejecting unknown settings and values
+def profile_pragmas(profile):
+    statements = []
+
+    for setting, value in profile.items():
+        if setting == "readers":
+            continue
+
+        if setting not in storage_pragmas:
+            raise ValueError(f"Unknown storage setting {setting}")
+
+        pragma, allowed = storage_pragmas[setting]
+
+        if allowed is int:
+            value = int(value)
+        elif str(value).upper() not in allowed:
+            raise ValueError(f"Storage setting {setting} must be one of {', '.join(allowed)}")
+        else:
+            value = str(value).upper()
+
+        statements.append(f"PRAGMA {pragma} = {value}")
+
+    return statements
+
+
+# Run PRAGMA statements on every new connection of an engine
+def apply_pragmas_on_connect(target, statements):
+    @event.listens_for(target, "connect")
+    def apply_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+
+        for statement in statements:
+            cursor.execute(statement)
+
+        cursor.close()
+
+
+# Apply a storage profile from config.yml: PRAGMAs on every connection and, with readers set, a pool of
+# that many query-only connections that serve reads alongside the writer
+def configure_storage(profile):
+    global read_engine
+    statements = profile_pragmas(profile)
+
+    apply_pragmas_on_connect(engine, statements)
+    engine.dispose()
+
+    if profile.get("readers"):
+        # The journal mode belongs to the database file, so only the writer sets it
+        read_statements = [statement for statement in statements if "journal_mode" not in statement]
+        read_engine = create_engine(engine.url, pool_size=int(profile["readers"]), max_overflow=0)
+        apply_pragmas_on_connect(read_engine, read_statements + ["PRAGMA query_only = ON"])
+
+
+# Sort key of the last row on each page already served, so page numbers can seek instead of using OFFSET
+page_cursors = {}
+page_cursors_lock = threading.Lock()
+max_page_cursors = 1000
+
+# Bumped on every reset, so boundaries read before a reset aren't stored after it
+page_cursors_generation = 0
+
+
+# Forget the page boundaries a write could have moved, which are the transaction pages of the given characters and
+# the character pages of the given guilds, or every boundary when neither is given
+def reset_page_cursors(character_ids=None, guild_ids=None):
+    global page_cursors_generation
+
+    with page_cursors_lock:
+        page_cursors_generation += 1
+
+        if character_ids is None and guild_ids is None:
+            page_cursors.clear()
+            return
+
+        owners = {"transactions": set(character_ids or ()), "characters": set(guild_ids or ())}
+
+        for key in [key for key in page_cursors if key[1] in owners[key[0]]]:
+            del page_cursors[key]
+
+
+# Bounded LRU cache of committed characters by id and by guild and name, so hot lookups skip SQL.
+# Entries are detached copies shared between threads, and expire after ttl seconds in case another process
+# wrote to the database.
+class CharacterCache:
+    def __init__(self, max_size=4096, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.by_id = OrderedDict()
+        self.ids = {}
+        self.lock = threading.Lock()
+        self.generation = 0
+
+    # Get a cached character by id, or by guild and name, marking it as recently used
+    def get(self, character_id=None, guild_id=None, name=None):
+        with self.lock:
+            if character_id is None:
+                character_id = self.ids.get((guild_id, name))
+
+            entry = self.by_id.get(character_id)
+
+            if not entry:
+                return None
+
+            character, expires = entry
+            if expires < time.monotonic():
+                self.forget(character_id)
+                return None
+
+            self.by_id.move_to_end(character_id)
+            return character
+
+    # Cache a copy of a character read while nothing was invalidated since generation, evicting the least
+    # recently used entries past the size limit
+    def put(self, character, generation):
+        copy = Character(**{attribute.key: getattr(character, attribute.key)
+                            for attribute in inspect(Character).column_attrs})
+
+        with self.lock:
+            if generation != self.generation or not self.max_size:
+                return
+
+            self.forget(copy.id)
+            self.by_id[copy.id] = (copy, time.monotonic() + self.ttl)
+            self.ids[(copy.guild_id, copy.name)] = copy.id
+
+            while len(self.by_id) > self.max_size:
+                self.forget(next(iter(self.by_id)))
+
+    # Drop a character by id together with its name entry, with the lock held
+    def forget(self, character_id):
+        entry = self.by_id.pop(character_id, None)
+
+        if entry:
+            self.ids.pop((entry[0].guild_id, entry[0].name), None)
+
+    # Drop the given characters, or everything, so the next lookup reads them again
+    def invalidate(self, character_ids=None):
+        with self.lock:
+            self.generation += 1
+
+            if character_ids is None:
+                self.by_id.clear()
+                self.ids.clear()
+            else:
+                for character_id in character_ids:
+                    self.forget(character_id)
+
+
+character_cache = CharacterCache()
+
+
+# Read a character through the cache. Writes read the database directly so they see their own uncommitted
+# changes, and what they read is never cached.
+def cached_character(statement, character_id=None, guild_id=None, name=None):
+    writing = session.info.get("writing")
+    character = None if writing else character_cache.get(character_id, guild_id, name)
+
+    if character is None:
+        generation = character_cache.generation
+
+        # Plain table UPDATEs don't touch loaded objects, so a write reloads them
+        character = session.execute(statement.execution_options(populate_existing=bool(writing))).scalar()
+
+        if character is not None and not writing:
+            character_cache.put(character, generation)
+
+    return character
+
+
+# Callbacks run after a commit as listener(changed, deleted), where changed are the characters
+# with their new id, name, ap, rp, player and guild_id, and deleted are the ids of removed characters
+character_listeners = []
+
+# Columns handed to the character listeners
+standing_columns = [Character.id, Character.name, Character.ap, Character.rp, Character.player, Character.guild_id]
+
+
+# Roll back a failed write and drop the given characters, or every character, from the cache in case they were
+# read while the write was under way
+def abandon_write(character_ids=None):
+    session.rollback()
+    character_cache.invalidate(character_ids)
+
+
+# Tell everything that caches character state about a committed change to the given characters and the removal
+# of the given deleted characters
+def characters_changed(changed, deleted=()):
+    characters = list(changed) + list(deleted)
+    deleted_ids = [character.id for character in deleted]
+    reset_page_cursors([character.id for character in characters], {character.guild_id for character in characters})
+    character_cache.invalidate([character.id for character in characters])
+
+    for listener in character_listeners:
+        listener(changed, deleted_ids)
+
+
+# Add a new character to a guild in the current transaction without committing.
+# Returns whether it was created and the new character, which fails if the name is taken in that guild.
+def stage_character(guild_id, name, player):
+    if get_character_by_name(guild_id, name):
+        return False, None
+
+    character = Character(guild_id=guild_id, name=name, player=player)
+    session.add(character)
+    session.flush()
+    change_counter(session, character_counter(guild_id), 1)
+    return True, character
 
 
 # Create new character in database
-def create_character(name, player):
+def create_character(guild_id, name, player):
     try:
-        character = Character(name=name, player=player)
-        session.add(character)
+        created, character = stage_character(guild_id, name, player)
+
+        if not created:
+            session.rollback()
+            return False
     except:
-        session.rollback()
+        abandon_write()
         return False
     else:
         session.commit()
+        characters_changed([character])
         return True
 
 
-# Delete a character
-def delete_character(name):
-    try:
-        character = get_character_by_name(name)
+# Delete a guild's character in the current transaction without committing, queueing its transactions for
+# purge_deleted_transactions. Returns whether it was deleted and the deleted character.
+def stage_delete(guild_id, name, archive=False):
+    character = get_character_by_name(guild_id, name)
 
-        if not character:
-            return False
+    if not character:
+        return False, None
 
-        transactions = get_all_character_transactions(name)
+    session.execute(delete(Character).where(Character.id == character.id))
+    session.execute(delete(BalanceCheckpoint).where(BalanceCheckpoint.character_id == character.id))
+    session.add(PendingDeletion(character_id=character.id, name=character.name, archive=archive,
+                                total=character.transaction_count, date=datetime.datetime.now(datetime.timezone.utc)))
+    session.flush()
+    change_counter(session, character_counter(guild_id), -1)
+    return True, character
 
-        for transaction in transactions:
-            session.delete(transaction)
 
-        session.delete(character)
+# Delete a character right away and queue its transactions for removal by purge_deleted_transactions,
+# so a long history never holds the write lock in one go. With archive the transactions are kept aside.
+def delete_character(guild_id, name, archive=False):
+    try:
+        deleted, character = stage_delete(guild_id, name, archive)
+
+        if not deleted:
+            return False
     except:
-        session.rollback()
+        abandon_write()
         return False
     else:
         session.commit()
+        characters_changed([], [character])
         return True
 
 
-# Erase a transaction and refund it
-def erase_transaction(transaction_id):
+# Remove up to chunk_size transactions of a deleted character in one short transaction, archiving them if asked.
+# Returns the number removed, 0 once nothing is left, or False on failure.
+def purge_deleted_transactions(character_id, chunk_size=1000):
     try:
-        transaction = get_transaction_by_id(transaction_id)
+        pending = session.get(PendingDeletion, character_id)
 
-        if not transaction:
-            return False
+        if not pending:
+            return 0
 
-        if transaction.currency == "AP":
-            session.query(Character).where(Character.id == transaction.character_id).update(
-                {Character.ap: Character.ap + transaction.amount})
-        elif transaction.currency == "RP":
-            session.query(Character).where(Character.id == transaction.character_id).update(
-                {Character.ap: Character.ap + transaction.amount})
+        ids = session.execute(select(Transaction.id).where(Transaction.character_id == character_id).limit(
+            chunk_size)).scalars().all()
 
-        session.delete(transaction)
+        if pending.archive and ids:
+            session.execute(insert(DeletedTransaction).from_select(
+                ["id", "character_id", "character_name", "amount", "currency", "user", "reason", "date", "deleted"],
+                select(Transaction.id, Transaction.character_id, literal(pending.name), Transaction.amount,
+                       Transaction.currency, Transaction.user, Transaction.reason, Transaction.date,
+                       literal(pending.date, DateTime)).where(Transaction.id.in_(ids))))
+
+        if ids:
+            session.execute(delete(Transaction).where(Transaction.id.in_(ids)))
+            removed = len(ids)
+        else:
+            # Once the hot rows are gone, remove the cold storage blocks one at a time
+            block = session.execute(select(TransactionArchive).where(
+                TransactionArchive.character_id == character_id).limit(1)).scalar()
+
+            if block:
+                if pending.archive:
+                    session.execute(insert(DeletedTransaction), [
+                        {"id": transaction.id, "character_id": character_id, "character_name": pending.name,
+                         "amount": transaction.amount, "currency": transaction.currency, "user": transaction.user,
+                         "reason": transaction.reason, "date": transaction.date, "deleted": pending.date}
+                        for transaction in unpack_archive(block)])
+
+                session.delete(block)
+                removed = block.count
+            else:
+                session.delete(pending)
+                removed = 0
     except:
         session.rollback()
         return False
     else:
         session.commit()
-        return True
+        return removed
 
-# Do a transaction and modify the associated character's currency appropriately
-def do_transaction(character_name, user, currency, amount, reason):
-    try:
-        character = get_character_by_name(character_name)
 
-        if not character:
-            return False
+# Get deleted characters whose transactions haven't been removed yet
+def get_pending_deletions():
+    return session.execute(select(PendingDeletion)).scalars().all()
+
+
+# Erase a guild's transaction in the current transaction without committing.
+# Returns whether it existed and the character's new standing, if the character still exists.
+def stage_erase(guild_id, transaction_id):
+    transaction = get_transaction_by_id(guild_id, transaction_id)
+
+    if not transaction:
+        return False, None
+
+    changes = {Character.transaction_count: Character.transaction_count - 1}
+    balance = balance_column(transaction.currency)
 
-        if currency == "AP":
-            if amount < 0:
-                if character.ap + amount < 0:
-                    return False
+    if balance is not None:
+        changes[balance] = balance - transaction.amount
 
+    character = session.execute(update(Character).where(Character.id == transaction.character_id).values(
+        changes).returning(*standing_columns)).first()
 
-            transaction = Transaction(character_id=character.id, currency=currency, amount=amount, user=user,
-                                      reason=reason, date=datetime.datetime.now(datetime.timezone.utc))
-            session.add(transaction)
-            session.query(Character).where(Character.id == character.id).update({Character.ap: Character.ap + amount})
-        elif currency == "RP":
-            if amount < 0:
-                if character.rp + amount < 0:
-                    return False
+    roll_up(session, [{"guild_id": transaction.guild_id, "character_id": transaction.character_id,
+                       "user": transaction.user, "currency": transaction.currency, "amount": transaction.amount,
+                       "date": transaction.date}], -1)
+    shift_checkpoints(session, [{"character_id": transaction.character_id, "date": transaction.date,
+                                 "ap": -transaction.amount if transaction.currency == "AP" else 0,
+                                 "rp": -transaction.amount if transaction.currency == "RP" else 0, "count": -1}])
+    session.delete(transaction)
+    session.flush()
+    return True, character
 
 
-            transaction = Transaction(character_id=character.id, currency=currency, amount=amount, user=user,
-                                      reason=reason, date=datetime.datetime.now(datetime.timezone.utc))
-            session.add(transaction)
-            session.query(Character).where(Character.id == character.id).update({Character.rp: Character.rp + amount})
+# Erase a transaction and refund it
+def erase_transaction(guild_id, transaction_id):
+    try:
+        erased, character = stage_erase(guild_id, transaction_id)
+
+        if not erased:
+            return False
     except:
-        session.rollback()
+        abandon_write()
         return False
     else:
         session.commit()
+        characters_changed([character] if character else [])
         return True
 
 
-# Get a character by name
-def get_character_by_name(name) -> Character:
-    result = session.execute(select(Character).where(Character.name == name)).first()
-    if result:
-        return result[0]
+# Outcomes of applying a ledger transaction
+TRANSACTION_DONE = "done"
+TRANSACTION_INSUFFICIENT = "insufficient"
+TRANSACTION_NOT_FOUND = "not found"
+TRANSACTION_FAILED = "failed"
+
+
+# Get the balance column for a currency
+def balance_column(currency):
+    if currency == "AP":
+        return Character.ap
+    elif currency == "RP":
+        return Character.rp
     else:
         return None
 
-# Get a character by id
-def get_character_by_id(char_id) -> Character:
-    result = session.execute(select(Character).where(Character.id == char_id)).first()
-    if result:
-        return result[0]
+
+# Balance UPDATEs by balance column and whether the balance guard applies
+balance_updates = {}
+
+
+# Get the plain table UPDATE that moves a guild's character's balance by an amount and returns their new standing.
+# Each is built once, since building it and synchronizing the session cost more than running it.
+def balance_update(balance, guarded):
+    key = (balance.key, guarded)
+
+    if key not in balance_updates:
+        table = Character.__table__
+        column = table.c[balance.key]
+        statement = update(table).where(
+            table.c.guild_id == bindparam("u_guild_id"), table.c.name == bindparam("u_name")).values(
+            {column: column + bindparam("u_amount"), table.c.transaction_count: table.c.transaction_count + 1}).returning(
+            *[table.c[attribute.key] for attribute in standing_columns], table.c.transaction_count)
+
+        # The balance guard lives in the WHERE clause so concurrent debits can't both pass it
+        if guarded:
+            statement = statement.where(column + bindparam("u_amount") >= 0)
+
+        balance_updates[key] = statement
+
+    return balance_updates[key]
+
+
+# Debit or credit a character in one conditional UPDATE and log it, in the current transaction without committing.
+# Returns the outcome and the character's new standing when it was applied.
+def stage_transaction(guild_id, character_name, user, currency, amount, reason):
+    balance = balance_column(currency)
+
+    if balance is None:
+        return TRANSACTION_FAILED, None
+
+    character = session.execute(balance_update(balance, amount < 0), {
+        "u_guild_id": guild_id, "u_name": character_name, "u_amount": amount}).first()
+
+    if character is None:
+        if get_character_by_name(guild_id, character_name):
+            return TRANSACTION_INSUFFICIENT, None
+
+        return TRANSACTION_NOT_FOUND, None
+
+    transaction = {"guild_id": guild_id, "character_id": character.id, "currency": currency, "amount": amount,
+                   "user": user, "reason": reason, "date": datetime.datetime.now(datetime.timezone.utc)}
+    session.execute(insert(Transaction.__table__), transaction)
+    roll_up(session, [transaction])
+    checkpoint_before(session, [character], currency, amount, transaction["date"])
+    return TRANSACTION_DONE, character
+
+
+# Debit or credit a character in one conditional UPDATE and log it in the same transaction
+def apply_transaction(guild_id, character_name, user, currency, amount, reason):
+    try:
+        outcome, character = stage_transaction(guild_id, character_name, user, currency, amount, reason)
+
+        if outcome != TRANSACTION_DONE:
+            session.rollback()
+            return outcome
+    except:
+        abandon_write()
+        return TRANSACTION_FAILED
     else:
+        session.commit()
+        characters_changed([character])
+        return TRANSACTION_DONE
+
+
+# Write operations that apply_batch can group, each returning its result and the changed character
+staged_operations = {
+    "create_character": stage_character,
+    "erase_transaction": stage_erase,
+    "apply_transaction": stage_transaction,
+    "delete_character": stage_delete,
+}
+
+
+# Apply a batch of (operation name, arguments) write operations in order in one transaction with one commit.
+# Without commit the transaction is left open for the caller to continue or roll back.
+# Returns each operation's result, or None if the batch failed and nothing was written.
+def apply_batch(operations, commit=True):
+    results = []
+    changed = []
+    deleted = []
+
+    try:
+        for operation, arguments in operations:
+            result, character = staged_operations[operation](*arguments)
+            results.append(result)
+
+            if character is None:
+                continue
+            elif operation == "delete_character":
+                deleted.append(character)
+            else:
+                changed.append(character)
+    except:
+        abandon_write([character.id for character in changed + deleted])
         return None
+    else:
+        if commit:
+            session.commit()
+            deleted_ids = {character.id for character in deleted}
+            characters_changed([character for character in changed if character.id not in deleted_ids], deleted)
+
+        return results
+
 
+# Do a transaction and modify the associated character's currency appropriately
+def do_transaction(guild_id, character_name, user, currency, amount, reason):
+    return apply_transaction(guild_id, character_name, user, currency, amount, reason) == TRANSACTION_DONE
+
+
+# Apply the same transaction to many of a guild's characters, chosen by name or by owner, in one commit.
+# Returns the names that were changed, the requested names that don't exist and the names without enough funds.
+def do_bulk_transaction(guild_id, character_names, players, user, currency, amount, reason):
+    balance = balance_column(currency)
+
+    if balance is None:
+        return False
+
+    try:
+        characters = session.execute(select(Character.id, Character.name).where(Character.guild_id == guild_id).where(
+            or_(Character.name.in_(character_names), Character.player.in_(players)))).all()
+        found = {character.name for character in characters}
+        missing = [name for name in character_names if name not in found]
+
+        statement = update(Character).where(Character.id.in_([character.id for character in characters])).values(
+            {balance: balance + amount, Character.transaction_count: Character.transaction_count + 1}).returning(
+            *standing_columns, Character.transaction_count)
 
-# Get a character by transaction id
-def get_character_by_transaction_id(transaction_id) -> Character:
-    transaction = get_transaction_by_id(transaction_id)
-    character = session.execute(select(Character).where(Character.id == transaction.character_id)).first()
-    if character:
-        return character[0]
+        if amount < 0:
+            statement = statement.where(balance + amount >= 0)
+
+        updated = session.execute(statement).all()
+        changed = {character.id for character in updated}
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+        if changed:
+            transactions = [{"guild_id": guild_id, "character_id": character_id, "currency": currency,
+                             "amount": amount, "user": user, "reason": reason, "date": now} for character_id in changed]
+            session.execute(insert(Transaction), transactions)
+            roll_up(session, transactions)
+            checkpoint_before(session, updated, currency, amount, now)
+    except:
+        abandon_write()
+        return False
     else:
+        session.commit()
+        characters_changed(updated)
+        return ([character.name for character in characters if character.id in changed], missing,
+                [character.name for character in characters if character.id not in changed])
+
+
+# Get a guild's character by name
+def get_character_by_name(guild_id, name) -> Character:
+    return cached_character(select(Character).where(Character.guild_id == guild_id, Character.name == name),
+                            guild_id=guild_id, name=name)
+
+# Get a character by id
+def get_character_by_id(char_id) -> Character:
+    return cached_character(select(Character).where(Character.id == char_id), character_id=char_id)
+
+
+# Get a character by the id of one of their guild's transactions
+def get_character_by_transaction_id(guild_id, transaction_id) -> Character:
+    transaction = get_transaction_by_id(guild_id, transaction_id)
+
+    if not transaction:
         return None
 
+    return get_character_by_id(transaction.character_id)
+
 
-# Get a character by name
-def get_transaction_by_id(transaction_id) -> Transaction:
-    result =  session.execute(select(Transaction).where(Transaction.id == transaction_id)).first()
+# Get a guild's transaction by id
+def get_transaction_by_id(guild_id, transaction_id) -> Transaction:
+    result =  session.execute(select(Transaction).where(Transaction.id == transaction_id,
+                                                        Transaction.guild_id == guild_id)).first()
     if result:
         return result[0]
     else:
         return None
 
 
-# Get all characters a player has
-def get_characters_by_owner(player):
-    return session.execute(select(Character).where(Character.player == player)).all()
+# Get every character's id, name, balances, player and guild for building in-memory indexes
+def get_character_standings():
+    return session.execute(select(*standing_columns)).all()
 
 
-# Get all characters
-def get_all_characters(page, page_size, currency):
-    if currency == "AP":
-        return session.execute(select(Character).order_by(
-            desc(Character.ap), func.lower(Character.name)).limit(page_size).offset(page_size * (page - 1))).all()
+# Get all characters a player has in a guild
+def get_characters_by_owner(guild_id, player):
+    return session.execute(select(Character).where(Character.guild_id == guild_id, Character.player == player)).all()
+
 
+# Sort keys for a character ordering as (column, descending) pairs, ending in the id as a tie-breaker
+def character_sort_keys(currency):
+    if currency == "AP":
+        return [(Character.ap, True), (func.lower(Character.name), False), (Character.id, False)]
     elif currency == "RP":
-        return session.execute(select(Character).order_by(
-            desc(Character.rp), func.lower(Character.name)).limit(page_size).offset(page_size * (page - 1))).all()
+        return [(Character.rp, True), (func.lower(Character.name), False), (Character.id, False)]
+    else:
+        return [(func.lower(Character.name), False), (Character.id, False)]
+
+
+# Sort keys for a character's transaction log, newest first
+transaction_sort_keys = [(Transaction.date, True), (Transaction.id, True)]
+
+
+# Build a WHERE clause that only matches rows sorting after the given cursor
+def seek_after(keys, cursor):
+    clause = None
+
+    for (column, descending), value in reversed(list(zip(keys, cursor))):
+        step = column < value if descending else column > value
+        clause = step if clause is None else or_(step, and_(column == value, clause))
+
+    return clause
+
+
+# Get one page of rows after the cursor, returning the rows and the cursor that ends the page
+def seek_page(statement, keys, cursor, page_size):
+    statement = statement.add_columns(*[column for column, _ in keys]).order_by(
+        *[desc(column) if descending else column for column, descending in keys]).limit(page_size)
+
+    if cursor is not None:
+        statement = statement.where(seek_after(keys, cursor))
+
+    rows = session.execute(statement).all()
+
+    if len(rows) < page_size:
+        return rows, None
+
+    return rows, tuple(rows[-1][-len(keys):])
+
+
+# Remember page boundaries read while nothing was reset since generation
+def store_page_cursors(cache_key, cursors, generation):
+    with page_cursors_lock:
+        if generation == page_cursors_generation:
+            page_cursors.setdefault(cache_key, {0: None}).update(cursors)
+
+
+# Find the cursor ending the page before the given page number, walking forward from the deepest known page.
+# Returns whether the page exists, its cursor and the generation the boundaries were read in.
+def find_page_cursor(cache_key, statement, keys, page, page_size):
+    with page_cursors_lock:
+        if len(page_cursors) > max_page_cursors:
+            page_cursors.clear()
+        cursors = dict(page_cursors.setdefault(cache_key, {0: None}))
+        generation = page_cursors_generation
+
+    known = max(number for number in cursors if number < page)
+
+    if known < page - 1:
+        statement = statement.with_only_columns(*[column for column, _ in keys]).order_by(
+            *[desc(column) if descending else column for column, descending in keys]).limit(
+            page_size * (page - 1 - known))
+
+        if cursors[known] is not None:
+            statement = statement.where(seek_after(keys, cursors[known]))
+
+        rows = session.execute(statement).all()
+
+        for index in range(page_size - 1, len(rows), page_size):
+            cursors[known + 1 + index // page_size] = tuple(rows[index])
+
+        store_page_cursors(cache_key, cursors, generation)
+
+    if page - 1 not in cursors:
+        return False, None, generation
+
+    return True, cursors[page - 1], generation
+
+
+# Get a page by number on top of keyset pagination
+def get_page(cache_key, statement, keys, page, page_size):
+    if page < 1:
+        return []
+
+    found, cursor, generation = find_page_cursor(cache_key, statement, keys, page, page_size)
+
+    if not found:
+        return []
+
+    rows, next_cursor = seek_page(statement, keys, cursor, page_size)
+
+    if next_cursor is not None:
+        store_page_cursors(cache_key, {page: next_cursor}, generation)
+
+    return rows
+
+
+# Get the page of a guild's characters after a cursor, returning the rows and the cursor for the next page
+def get_characters_after(guild_id, cursor, page_size, currency):
+    return seek_page(select(Character).where(Character.guild_id == guild_id), character_sort_keys(currency), cursor,
+                     page_size)
+
+
+# Get all characters of a guild
+def get_all_characters(guild_id, page, page_size, currency):
+    return get_page(("characters", guild_id, currency, page_size), select(Character).where(
+        Character.guild_id == guild_id), character_sort_keys(currency), page, page_size)
+
 
+def get_all_character_pages(guild_id, page_size):
+    return math.ceil(get_counter(character_counter(guild_id)) / page_size)
+
+
+# Get the current value of a named counter
+def get_counter(name):
+    return session.execute(select(Counter.value).where(Counter.name == name)).scalar() or 0
+
+
+# Recompute the transaction and character counters from scratch
+def repair_counters():
+    try:
+        recount(session)
+    except:
+        session.rollback()
+        return False
     else:
-        return session.execute(select(Character).order_by(
-            func.lower(Character.name)).limit(page_size).offset(page_size * (page - 1))).all()
+        session.commit()
+        reset_page_cursors()
+        character_cache.invalidate()
+        return True
+
+
+# Hand characters and transactions created before guilds were tracked to the given guild, before the
+# in-memory indexes are loaded. Returns the number of characters claimed, or False if a name is already taken.
+def claim_unassigned(guild_id):
+    try:
+        claimed = session.execute(update(Character).where(Character.guild_id == 0).values(guild_id=guild_id)).rowcount
+
+        if claimed:
+            session.execute(update(Transaction).where(Transaction.guild_id == 0).values(guild_id=guild_id))
+            session.execute(update(DailyRollup).where(DailyRollup.guild_id == 0).values(guild_id=guild_id))
+            recount(session)
+    except:
+        session.rollback()
+        return False
+    else:
+        session.commit()
+        reset_page_cursors()
+        character_cache.invalidate()
+        return claimed
+
+
+# Recompute a guild's daily rollups from its ledger
+def backfill_rollups(guild_id):
+    try:
+        rebuild_rollups(session, guild_id)
+    except:
+        session.rollback()
+        return False
+    else:
+        session.commit()
+        return True
+
+
+# Get a guild's economy between two days from the daily rollups, optionally in one currency: inflow, outflow and
+# transaction count per currency, the characters that spent the most, the users that gave the most, and inflow
+# and outflow per day, week or month depending on the length of the range
+def get_economy(guild_id, since, until, currency=None, limit=5):
+    filters = [DailyRollup.guild_id == guild_id, DailyRollup.day >= since, DailyRollup.day <= until]
+
+    if currency is not None:
+        filters.append(DailyRollup.currency == currency)
+
+    inflow = func.sum(DailyRollup.inflow)
+    outflow = func.sum(DailyRollup.outflow)
+    totals = session.execute(select(DailyRollup.currency, inflow, outflow, func.sum(DailyRollup.count)).where(
+        *filters).group_by(DailyRollup.currency).order_by(DailyRollup.currency)).all()
+    spenders = session.execute(select(Character.name, outflow).join(
+        Character, Character.id == DailyRollup.character_id).where(*filters).group_by(
+        DailyRollup.character_id).having(outflow > 0).order_by(desc(outflow)).limit(limit)).all()
+    givers = session.execute(select(DailyRollup.user, inflow).where(*filters).group_by(DailyRollup.user).having(
+        inflow > 0).order_by(desc(inflow)).limit(limit)).all()
+
+    days = (until - since).days
+    period = func.strftime("%Y-%m-%d" if days <= 31 else "%Y-W%W" if days <= 183 else "%Y-%m", DailyRollup.day)
+    trend = session.execute(select(period, inflow, outflow).where(*filters).group_by(period).order_by(
+        period)).all()
+    return totals, spenders, givers, trend
+
+
+# Sum the AP, RP and number of a character's transactions, archived ones included, dated from start up to but
+# not including end, where either end can be left open
+def ledger_delta(character_id, start=None, end=None):
+    filters = [Transaction.character_id == character_id]
+    blocks = select(TransactionArchive).where(TransactionArchive.character_id == character_id)
+
+    # Stored dates have no time zone, so the bounds are compared without one too
+    start = start.replace(tzinfo=None) if start is not None else None
+    end = end.replace(tzinfo=None) if end is not None else None
+
+    if start is not None:
+        filters.append(Transaction.date >= start)
+        blocks = blocks.where(TransactionArchive.last_date >= start)
+
+    if end is not None:
+        filters.append(Transaction.date < end)
+        blocks = blocks.where(TransactionArchive.first_date < end)
+
+    ap, rp, count = session.execute(select(
+        func.coalesce(func.sum(case((Transaction.currency == "AP", Transaction.amount), else_=0)), 0),
+        func.coalesce(func.sum(case((Transaction.currency == "RP", Transaction.amount), else_=0)), 0),
+        func.count()).where(*filters)).first()
+
+    for block in session.execute(blocks).scalars():
+        for transaction in unpack_archive(block):
+            if (start is None or transaction.date >= start) and (end is None or transaction.date < end):
+                ap += transaction.amount if transaction.currency == "AP" else 0
+                rp += transaction.amount if transaction.currency == "RP" else 0
+                count += 1
+
+    return ap, rp, count
+
+
+# Get a guild's character and their AP and RP from every transaction dated before the given time, starting from
+# the nearest checkpoint on either side so only the transactions in between are read
+def get_balance_at(guild_id, name, until):
+    character = get_character_by_name(guild_id, name)
+
+    if not character:
+        return False
+
+    before = session.execute(select(BalanceCheckpoint).where(
+        BalanceCheckpoint.character_id == character.id, BalanceCheckpoint.boundary <= until).order_by(
+        desc(BalanceCheckpoint.boundary)).limit(1)).scalar()
+
+    if before:
+        ap, rp, _ = ledger_delta(character.id, before.boundary, until)
+        return character, before.ap + ap, before.rp + rp
+
+    after = session.execute(select(BalanceCheckpoint).where(
+        BalanceCheckpoint.character_id == character.id, BalanceCheckpoint.boundary > until).order_by(
+        BalanceCheckpoint.boundary).limit(1)).scalar()
+
+    # Without a checkpoint after the time either, walk back from the current balances
+    if after:
+        ap, rp, _ = ledger_delta(character.id, until, after.boundary)
+        return character, after.ap - ap, after.rp - rp
+
+    ap, rp, _ = ledger_delta(character.id, until)
+    return character, character.ap - ap, character.rp - rp
+
+
+# Check the stored balances and transaction counts of every character, or a guild's characters, against their
+# latest checkpoint plus the transactions after it. Returns (guild_id, name, what, stored, expected) for each
+# mismatch.
+def reconcile_balances(guild_id=None):
+    latest = select(BalanceCheckpoint.character_id, func.max(BalanceCheckpoint.boundary).label("boundary")).group_by(
+        BalanceCheckpoint.character_id).subquery()
+    since = func.coalesce(latest.c.boundary, literal(datetime.datetime(1970, 1, 1), DateTime))
+    statement = select(
+        Character.id, Character.guild_id, Character.name, Character.ap, Character.rp, Character.transaction_count,
+        func.coalesce(BalanceCheckpoint.ap, 0).label("checkpoint_ap"),
+        func.coalesce(BalanceCheckpoint.rp, 0).label("checkpoint_rp"),
+        func.coalesce(BalanceCheckpoint.count, 0).label("checkpoint_count"),
+        func.coalesce(func.sum(case((Transaction.currency == "AP", Transaction.amount), else_=0)), 0).label(
+            "hot_ap"),
+        func.coalesce(func.sum(case((Transaction.currency == "RP", Transaction.amount), else_=0)), 0).label(
+            "hot_rp"),
+        func.count(Transaction.id).label("hot_count")).outerjoin(
+        latest, latest.c.character_id == Character.id).outerjoin(
+        BalanceCheckpoint, and_(BalanceCheckpoint.character_id == Character.id,
+                                BalanceCheckpoint.boundary == latest.c.boundary)).outerjoin(
+        Transaction, and_(Transaction.character_id == Character.id, Transaction.date >= since)).group_by(Character.id)
+    blocks = select(TransactionArchive.id, latest.c.boundary).outerjoin(
+        latest, latest.c.character_id == TransactionArchive.character_id).where(
+        TransactionArchive.last_date >= since)
+
+    if guild_id is not None:
+        statement = statement.where(Character.guild_id == guild_id)
+        blocks = blocks.where(TransactionArchive.character_id.in_(
+            select(Character.id).where(Character.guild_id == guild_id)))
+
+    expected = {}
+
+    for row in session.execute(statement):
+        expected[row.id] = {
+            "guild_id": row.guild_id,
+            "name": row.name,
+            "stored": {"AP": row.ap, "RP": row.rp, "transactions": row.transaction_count},
+            "expected": {"AP": row.checkpoint_ap + row.hot_ap, "RP": row.checkpoint_rp + row.hot_rp,
+                         "transactions": row.checkpoint_count + row.hot_count},
+        }
+
+    # Transactions after a checkpoint that were already moved into cold storage
+    for block_id, boundary in session.execute(blocks).all():
+        block = session.get(TransactionArchive, block_id)
+        character = expected.get(block.character_id)
+
+        for transaction in unpack_archive(block) if character else []:
+            if boundary is None or transaction.date >= boundary:
+                character["expected"]["AP"] += transaction.amount if transaction.currency == "AP" else 0
+                character["expected"]["RP"] += transaction.amount if transaction.currency == "RP" else 0
+                character["expected"]["transactions"] += 1
+
+        session.expunge(block)
+
+    return [(character["guild_id"], character["name"], what, character["stored"][what], character["expected"][what])
+            for character in expected.values() for what in ["AP", "RP", "transactions"]
+            if character["stored"][what] != character["expected"][what]]
+
+
+# Get the page of a character's transactions after a cursor, returning the transactions and the next cursor
+def get_character_transactions_after(guild_id, name, cursor, page_size):
+    character = get_character_by_name(guild_id, name)
 
+    if not character:
+        return False
 
-def get_all_character_pages(page_size):
-    return math.ceil(session.query(func.count(Character.id)).scalar() / page_size)
+    rows, next_cursor = seek_page(select(Transaction).where(Transaction.character_id == character.id),
+                                  transaction_sort_keys, cursor, page_size)
+    return [row[0] for row in rows], next_cursor
 
 
 # Get paginated transactions by character name
-def get_character_transactions(name, page, page_size):
-    character = get_character_by_name(name)
+def get_character_transactions(guild_id, name, page, page_size):
+    log = get_character_log(guild_id, name, page, page_size)
+
+    if not log:
+        return False
+
+    return log[0]
+
+
+# Get a page of a character's transactions and the number of pages with a single character lookup.
+# Pages past the transactions still in the transaction table continue into the archive.
+def get_character_log(guild_id, name, page, page_size):
+    character = get_character_by_name(guild_id, name)
 
     if not character:
         return False
 
-    return session.query(Transaction).where(Transaction.character_id == character.id).order_by(
-        desc(Transaction.date)).limit(page_size).offset(page_size * (page - 1)).all()
+    rows = get_page(("transactions", character.id, page_size),
+                    select(Transaction).where(Transaction.character_id == character.id),
+                    transaction_sort_keys, page, page_size)
+    transactions = [row[0] for row in rows]
+
+    if page >= 1 and len(transactions) < page_size:
+        archived = session.execute(select(func.sum(TransactionArchive.count)).where(
+            TransactionArchive.character_id == character.id)).scalar() or 0
+        hot = character.transaction_count - archived
+        transactions += get_archived_transactions(character.id, max(0, page_size * (page - 1) - hot),
+                                                  page_size - len(transactions))
+
+    return transactions, math.ceil(character.transaction_count / page_size)
+
+
+# Get archived transactions of a character, newest first, skipping the first offset of them
+def get_archived_transactions(character_id, offset, limit):
+    transactions = []
+    blocks = session.execute(select(TransactionArchive.id, TransactionArchive.count).where(
+        TransactionArchive.character_id == character_id).order_by(
+        desc(TransactionArchive.last_date), desc(TransactionArchive.last_transaction_id))).all()
+
+    for block_id, count in blocks:
+        if len(transactions) >= limit:
+            break
+
+        if offset >= count:
+            offset -= count
+            continue
+
+        block = session.get(TransactionArchive, block_id)
+        transactions += unpack_archive(block)[offset:offset + limit - len(transactions)]
+        offset = 0
+
+    return transactions
+
+
+# Get the ids of characters with transactions older than the cutoff
+def get_characters_to_archive(cutoff):
+    return session.execute(select(Transaction.character_id).where(Transaction.date < cutoff).distinct()).scalars().all()
+
+
+# Move up to batch_size of a character's transactions older than the cutoff, oldest first, into compressed
+# monthly archive blocks. Balances and counters are untouched. Returns the number archived, or False on failure.
+def archive_character_transactions(character_id, cutoff, batch_size=10000):
+    try:
+        transactions = session.execute(select(Transaction).where(
+            Transaction.character_id == character_id, Transaction.date < cutoff).order_by(
+            Transaction.date, Transaction.id).limit(batch_size)).scalars().all()
+        months = {}
+
+        for transaction in transactions:
+            months.setdefault((transaction.date.year, transaction.date.month), []).append(transaction)
+
+        for month in months.values():
+            month.reverse()
+            session.add(TransactionArchive(
+                character_id=character_id, count=len(month), first_date=month[-1].date, last_date=month[0].date,
+                last_transaction_id=month[0].id, data=zlib.compress(json.dumps([
+                    [transaction.id, transaction.amount, transaction.currency, transaction.user, transaction.reason,
+                     transaction.date.isoformat()] for transaction in month]).encode())))
+
+        ids = [transaction.id for transaction in transactions]
+
+        for start in range(0, len(ids), 500):
+            session.execute(delete(Transaction).where(Transaction.id.in_(ids[start:start + 500])))
+    except:
+        session.rollback()
+        return False
+    else:
+        session.commit()
+        reset_page_cursors([character_id], [])
+        return len(transactions)
+
+
+# Archive every transaction older than the cutoff, one character batch per commit
+def archive_transactions(cutoff, batch_size=10000):
+    archived = 0
+
+    for character_id in get_characters_to_archive(cutoff):
+        while True:
+            count = archive_character_transactions(character_id, cutoff, batch_size)
+
+            if count is False:
+                return False
+
+            archived += count
+
+            if count < batch_size:
+                break
+
+    return archived
+
+
+# Stream every archived transaction with its character's name and guild, one archive block at a time,
+# optionally only those of one guild
+def stream_archived_transactions(guild_id=None):
+    statement = select(TransactionArchive.id).order_by(TransactionArchive.id)
+
+    if guild_id is not None:
+        statement = statement.where(TransactionArchive.character_id.in_(
+            select(Character.id).where(Character.guild_id == guild_id)))
+
+    block_ids = session.execute(statement).scalars().all()
+
+    for block_id in block_ids:
+        block = session.get(TransactionArchive, block_id)
+        character = get_character_by_id(block.character_id)
+
+        for transaction in reversed(unpack_archive(block)):
+            yield {"id": transaction.id, "guild_id": character.guild_id if character else None,
+                   "character": character.name if character else None,
+                   "currency": transaction.currency, "amount": transaction.amount, "user": transaction.user,
+                   "reason": transaction.reason, "date": transaction.date}
+
+        session.expunge(block)
 
 
 # Get all transactions by character name
-def get_all_character_transactions(name):
-    character = get_character_by_name(name)
+def get_all_character_transactions(guild_id, name):
+    character = get_character_by_name(guild_id, name)
 
     if not character:
         return False
@@ -228,11 +1544,253 @@ def get_all_character_transactions(name):
 
 
 # Get transactions by character name
-def get_character_transaction_pages(name, page_size):
-    character = get_character_by_name(name)
+def get_character_transaction_pages(guild_id, name, page_size):
+    character = get_character_by_name(guild_id, name)
 
     if not character:
         return False
 
-    return math.ceil(session.query(func.count(Transaction.id)).where(
-        Transaction.character_id == character.id).scalar() / page_size)
\ No newline at end of file
+    return math.ceil(character.transaction_count / page_size)
+
+
+# Turn what a user typed into an FTS5 query matching reasons with every word, the last one as a prefix, in rows
+# whose other indexed columns equal the given values. Punctuation and FTS5 operators in the input can't break it.
+def search_query(words, columns):
+    terms = re.findall(r"\w+", words)
+
+    if not terms:
+        return None
+
+    filters = [f'{name} : "{str(value).replace(chr(34), chr(34) * 2)}"' for name, value in columns.items()
+               if value is not None]
+    return " AND ".join(filters + ["reason : (" + " ".join(f'"{term}"' for term in terms) + "*)"])
+
+
+# Search a guild's recent transactions by reason, best matches first, optionally only those in a currency,
+# by a user, of a character or between two dates. Returns a page of (transaction, character name) rows and the
+# number of pages, which is 0 past the last page, or False if the character doesn't exist.
+def search_transactions(guild_id, words, page, page_size, currency=None, user=None, character_name=None,
+                        since=None, until=None):
+    columns = {"guild_id": guild_id, "user": user, "currency": currency}
+
+    if character_name is not None:
+        character = get_character_by_name(guild_id, character_name)
+
+        if not character:
+            return False
+
+        columns["character_id"] = character.id
+
+    match = search_query(words, columns)
+
+    if match is None or page < 1:
+        return [], 0
+
+    matches = select(transaction_search.c.rowid.label("id"), transaction_search.c.rank.label("rank")).where(
+        transaction_search.c.transaction_search.op("MATCH")(match))
+    filters = [Transaction.guild_id == guild_id]
+
+    # The index has no dates, so a date range becomes the range of transaction ids inside it
+    if since is not None or until is not None:
+        if since is not None:
+            filters.append(Transaction.date >= since)
+
+        if until is not None:
+            filters.append(Transaction.date < until)
+
+        first, last = session.execute(select(func.min(Transaction.id), func.max(Transaction.id)).where(
+            *filters)).first()
+
+        if first is None:
+            return [], 0
+
+        matches = matches.where(transaction_search.c.rowid.between(first, last))
+
+    # Materialize the matches first, otherwise SQLite walks the guild's transactions and runs the MATCH per row
+    matches = matches.order_by(desc(transaction_search.c.rowid)).limit(max_search_matches).cte(
+        "matches").prefix_with("MATERIALIZED")
+    rows = session.execute(select(Transaction, Character.name, func.count().over()).select_from(matches).join(
+        Transaction, Transaction.id == matches.c.id).join(Character, Character.id == Transaction.character_id).where(
+        *filters).order_by(matches.c.rank, desc(Transaction.id)).limit(page_size).offset(
+        page_size * (page - 1))).all()
+
+    if not rows:
+        return [], 0
+
+    return [(transaction, name) for transaction, name, _ in rows], math.ceil(rows[0][2] / page_size)
+
+
+# Get stored names for the given discord ids that were updated after the cutoff
+def get_player_names(user_ids, cutoff):
+    return {player.id: player.name for player in session.execute(select(PlayerName).where(
+        PlayerName.id.in_(user_ids), PlayerName.updated >= cutoff)).scalars()}
+
+
+# Store or refresh discord names keyed by discord id
+def save_player_names(names):
+    try:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for user_id, name in names.items():
+            session.merge(PlayerName(id=user_id, name=name, updated=now))
+    except:
+        session.rollback()
+        return False
+    else:
+        session.commit()
+        return True
+
+
+# Stream every character in id order, optionally only those of one guild, fetching batch_size rows at a time
+def stream_characters(batch_size=1000, guild_id=None):
+    statement = select(Character.id, Character.guild_id, Character.name, Character.player, Character.ap,
+                       Character.rp).order_by(Character.id).execution_options(yield_per=batch_size)
+
+    if guild_id is not None:
+        statement = statement.where(Character.guild_id == guild_id)
+
+    yield from session.execute(statement)
+
+
+# Stream every transaction in id order with its character's name, optionally only those of one guild,
+# fetching batch_size rows at a time
+def stream_transactions(batch_size=1000, guild_id=None):
+    statement = select(
+        Transaction.id, Transaction.guild_id, Character.name.label("character"), Transaction.currency,
+        Transaction.amount, Transaction.user, Transaction.reason, Transaction.date).join(
+        Character, Character.id == Transaction.character_id).order_by(
+        Transaction.id).execution_options(yield_per=batch_size)
+
+    if guild_id is not None:
+        statement = statement.where(Transaction.guild_id == guild_id)
+
+    yield from session.execute(statement)
+
+
+# Insert a chunk of characters given as dicts of guild_id, name, player, ap and rp in one commit, skipping names
+# already taken in their guild. Returns the number of characters created.
+def import_characters(rows):
+    try:
+        created = session.execute(sqlite_insert(Character).values([
+            {"guild_id": row["guild_id"], "name": row["name"], "player": row["player"], "ap": row.get("ap", 0),
+             "rp": row.get("rp", 0), "transaction_count": 0} for row in rows]).on_conflict_do_nothing().returning(
+            *standing_columns)).all() if rows else []
+        guilds = {}
+
+        for character in created:
+            guilds[character.guild_id] = guilds.get(character.guild_id, 0) + 1
+
+        for guild_id, count in guilds.items():
+            change_counter(session, character_counter(guild_id), count)
+
+        # Opening balances have no transactions behind them, so they start from a checkpoint
+        now = datetime.datetime.now(datetime.timezone.utc)
+        opening = [{"character_id": character.id, "boundary": now, "ap": character.ap, "rp": character.rp, "count": 0}
+                   for character in created if character.ap or character.rp]
+
+        if opening:
+            session.execute(insert(BalanceCheckpoint), opening)
+    except:
+        abandon_write()
+        return False
+    else:
+        session.commit()
+        characters_changed(created)
+        return len(created)
+
+
+# Insert a chunk of transactions given as dicts of guild_id, character name, currency, amount, user, reason and
+# date in one commit, applying them to the balances without a balance check.
+# Returns the number of transactions imported and the character names that don't exist in their guild.
+def import_transactions(rows):
+    try:
+        names = {(row["guild_id"], row["character"]) for row in rows}
+        ids = {(guild_id, name): character_id for guild_id, name, character_id in session.execute(select(
+            Character.guild_id, Character.name, Character.id).where(
+            tuple_(Character.guild_id, Character.name).in_(names))).all()} if names else {}
+        ledger = []
+        totals = {}
+
+        for row in rows:
+            character_id = ids.get((row["guild_id"], row["character"]))
+
+            if character_id is None or balance_column(row["currency"]) is None:
+                continue
+
+            ledger.append({"guild_id": row["guild_id"], "character_id": character_id, "currency": row["currency"],
+                           "amount": row["amount"], "user": row["user"], "reason": row["reason"], "date": row["date"]})
+            total = totals.setdefault(character_id, {"b_id": character_id, "b_ap": 0, "b_rp": 0, "b_count": 0})
+            total["b_ap" if row["currency"] == "AP" else "b_rp"] += row["amount"]
+            total["b_count"] += 1
+
+        if ledger:
+            session.execute(insert(Transaction), ledger)
+            roll_up(session, ledger)
+            shift_checkpoints(session, [{"character_id": row["character_id"], "date": row["date"],
+                                         "ap": row["amount"] if row["currency"] == "AP" else 0,
+                                         "rp": row["amount"] if row["currency"] == "RP" else 0, "count": 1}
+                                        for row in ledger])
+
+            table = Character.__table__
+            session.execute(update(table).where(table.c.id == bindparam("b_id")).values(
+                ap=table.c.ap + bindparam("b_ap"), rp=table.c.rp + bindparam("b_rp"),
+                transaction_count=table.c.transaction_count + bindparam("b_count")), list(totals.values()))
+
+        changed = session.execute(select(*standing_columns).where(Character.id.in_(totals))).all()
+    except:
+        abandon_write()
+        return False
+    else:
+        session.commit()
+        characters_changed(changed)
+        return len(ledger), sorted(name for _, name in names - set(ids))
+
+
+# Representative statements for each query function, used to check that they hit an index
+def query_plan_statements():
+    seek = (0, "", 0)
+    statements = {
+        "get_character_by_name": select(Character).where(Character.guild_id == 0, Character.name == ""),
+        "get_character_by_id": select(Character).where(Character.id == 0),
+        "get_transaction_by_id": select(Transaction).where(Transaction.id == 0, Transaction.guild_id == 0),
+        "get_characters_by_owner": select(Character).where(Character.guild_id == 0, Character.player == 0),
+        "get_all_character_pages": select(Counter.value).where(Counter.name == character_counter(0)),
+        "search_transactions": select(transaction_search.c.rowid).where(
+            transaction_search.c.transaction_search.op("MATCH")("sword")).order_by(transaction_search.c.rank),
+        "get_character_transactions": select(Transaction).where(Transaction.character_id == 0).where(
+            seek_after(transaction_sort_keys, (datetime.datetime.now(), 0))).order_by(
+            *[desc(column) for column, _ in transaction_sort_keys]),
+    }
+
+    for currency in ["AP", "RP", None]:
+        keys = character_sort_keys(currency)
+        statements[f"get_all_characters ({currency or 'name'})"] = select(Character).where(
+            Character.guild_id == 0).where(seek_after(keys, seek[-len(keys):])).order_by(
+            *[desc(column) if descending else column for column, descending in keys])
+
+    return statements
+
+
+# Run EXPLAIN QUERY PLAN for every query function, returning the plans that scan a table or sort in memory
+def check_query_plans():
+    problems = {}
+
+    with engine.connect() as connection:
+        for name, statement in query_plan_statements().items():
+            compiled = statement.compile(engine)
+            parameters = tuple(compiled.params[key] for key in compiled.positiontup)
+            plan = [row[-1] for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", parameters)]
+
+            if any(("SCAN" in step and "INDEX" not in step) or "TEMP B-TREE" in step for step in plan):
+                problems[name] = plan
+
+    return problems
+
+
+if __name__ == '__main__':
+    plans = check_query_plans()
+
+    for query, plan in plans.items():
+        print(f"{query}: " + "; ".join(plan))
+
+    if not plans:
+        print("All queries use an index")
\ No newline at end of file
@@ -1,11 +1,26 @@
 # Load standard libraries
+import asyncio
+import datetime
 import discord
+import math
+import time
+import os
+import re
+import tempfile
 import yaml
 from pathlib import Path
 from discord.commands import Option
 
 # Load project files
+import async_database
+import coalescing
 import database
+import metrics
+from name_index import NameIndex
+from names import NameResolver
+from paging import PagedView, window_pages
+from rankings import RankIndex
+from write_queue import WriteQueue
 
 # Loads and validates config file
 def load_config(path):
@@ -40,17 +55,202 @@ def load_config(path):
 
 
 # Define globals for the bot
-bot = discord.Bot()
 config = load_config("config.yml")
 
+# Role mentions in bulk commands need the guild member lists, which take the privileged members intent. It has to
+# be turned on for the bot in the discord developer portal too, or the bot can't connect.
+intents = discord.Intents.default()
+intents.members = config.get("members_intent", False)
+
+# Large deployments can spread their guilds over several gateway shards
+bot = discord.AutoShardedBot(intents=intents) if config.get("sharded") else discord.Bot(intents=intents)
+names = NameResolver(bot, max_size=config.get("name_cache_size", 1024), ttl=config.get("name_cache_ttl", 3600),
+                     persist=config.get("persist_player_names", False))
+
+# Apply the SQLite storage profile before anything else opens a connection
+database.configure_storage(config.get("storage", {}))
+database.character_cache = database.CharacterCache(config.get("character_cache_size", 4096),
+                                                   config.get("character_cache_ttl", 300))
+
+# Ledger writes go through a group-commit queue when write_batch_ms is set, otherwise straight to the database
+writes = WriteQueue(config["write_batch_ms"]) if config.get("write_batch_ms") else async_database
+
+# Repeats of a write command within idempotency_window seconds get the first answer instead of writing again,
+# 0 turns this off
+coalescing.idempotency_window = config.get("idempotency_window", 10)
+
+# Record per-command latency, SQL statements and discord fetches
+metrics.install(database.engine, config.get("slow_query_ms"))
+
+if database.read_engine:
+    metrics.install(database.read_engine, config.get("slow_query_ms"))
+
+
+# Removes a deleted character's transactions chunk by chunk in the background, reporting progress if given a
+# function to report with
+async def purge_transactions(character_id, name, total, report=None):
+    removed = 0
+    reported = time.monotonic()
+
+    # The response can be deleted or its token expire, which stops the reports but not the purge
+    async def send_report(content):
+        nonlocal report
+
+        try:
+            await report(content)
+        except discord.HTTPException:
+            report = None
+
+    while True:
+        count = await async_database.purge_deleted_transactions(character_id, config.get("delete_chunk_size", 1000))
+
+        if count is False:
+            print(f"Failed to remove transactions of deleted character {name}, will retry on restart")
+            return
+
+        if not count:
+            break
+
+        removed += count
+
+        if report and time.monotonic() - reported > 2:
+            reported = time.monotonic()
+            await send_report(f"Deleted {name}, removed {removed}/{total} transactions")
+
+        # Let other commands' writes in between chunks
+        await asyncio.sleep(0)
+
+    if report:
+        await send_report(f"Deleted {name} and {removed} transactions")
+
+
+# Finish removing transactions of characters deleted before a restart
+@bot.listen("on_ready", once=True)
+async def resume_deletions():
+    for pending in await async_database.get_pending_deletions():
+        bot.loop.create_task(purge_transactions(pending.character_id, pending.name, pending.total))
+
+
+# Moves transactions older than archive_after_days into compressed cold storage once a day
+@bot.listen("on_ready", once=True)
+async def archive_old_transactions():
+    if not config.get("archive_after_days"):
+        return
+
+    while True:
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=config["archive_after_days"])
+
+        for character_id in await async_database.get_characters_to_archive(cutoff):
+            while await async_database.archive_character_transactions(character_id, cutoff, 1000) == 1000:
+                pass
+
+        await asyncio.sleep(86400)
+
+
+# Checks every character's balances against the ledger every reconcile_every_hours and reports any drift
+@bot.listen("on_ready", once=True)
+async def reconcile_periodically():
+    if not config.get("reconcile_every_hours"):
+        return
+
+    while True:
+        for guild_id, name, what, stored, expected in await async_database.reconcile_balances():
+            print(f"Guild {guild_id}: {name} has {stored} {what} but the ledger says {expected}")
+
+        await asyncio.sleep(config["reconcile_every_hours"] * 3600)
+
+
+@bot.listen("on_ready", once=True)
+async def start_metrics_exports():
+    if config.get("metrics_port"):
+        await metrics.serve_prometheus(config["metrics_port"])
+
+    if config.get("metrics_file"):
+        bot.loop.create_task(metrics.write_prometheus_file(config["metrics_file"]))
+
+
+# Characters created before guilds were tracked belong to legacy_guild_id, by default the first guild
+if database.claim_unassigned(config.get("legacy_guild_id", config["guild_ids"][0])) is False:
+    print("Characters from before guilds were tracked clash with names in the legacy guild!")
+
+# Leaderboard and character name index of each guild, kept in memory and up to date as characters change
+ranks = {}
+character_names = {}
+
+
+# Get a guild's leaderboard and character name index, creating empty ones the first time
+def guild_indexes(guild_id):
+    return ranks.setdefault(guild_id, RankIndex()), character_names.setdefault(guild_id, NameIndex())
+
+
+# Apply committed character changes to the indexes of their guilds
+def update_guild_indexes(changed, deleted=()):
+    guilds = {}
+
+    for character in changed:
+        guilds.setdefault(character.guild_id, []).append(character)
+
+    # Deletions only carry the character id, so they go to every guild
+    for guild_id in set(guilds) | (set(ranks) if deleted else set()):
+        guild_ranks, guild_names = guild_indexes(guild_id)
+        guild_ranks.update(guilds.get(guild_id, []), deleted)
+        guild_names.update(guilds.get(guild_id, []), deleted)
+
+
+# Rebuild every guild's leaderboard and name index from the given standings, dropping cached characters and page
+# boundaries too, so writes made outside the bot such as admin.py or ledger_io.py runs show up
+def load_guild_indexes(standings):
+    guilds = {}
+
+    for standing in standings:
+        guilds.setdefault(standing.guild_id, []).append(standing)
+
+    for guild_id in set(guilds) | set(ranks):
+        guild_ranks, guild_names = guild_indexes(guild_id)
+        guild_ranks.load(guilds.get(guild_id, []))
+        guild_names.load(guilds.get(guild_id, []))
+
+    database.character_cache.invalidate()
+    database.reset_page_cursors()
+
+
+load_guild_indexes(database.get_character_standings())
+
+# Commands use short-lived sessions in the worker threads, so let go of everything loaded at startup
+database.session.remove()
+database.character_listeners.append(update_guild_indexes)
+
+
+# Reloads the guild indexes every reload_indexes_every_minutes, for databases that other tools write to
+@bot.listen("on_ready", once=True)
+async def reload_indexes_periodically():
+    if not config.get("reload_indexes_every_minutes"):
+        return
+
+    while True:
+        await asyncio.sleep(config["reload_indexes_every_minutes"] * 60)
+        load_guild_indexes(await async_database.get_character_standings())
+
+
+# Suggests character names starting with what the user has typed
+async def character_autocomplete(ctx: discord.AutocompleteContext):
+    return guild_indexes(ctx.interaction.guild_id)[1].search(ctx.value or "")
+
+
+# Suggests only the user's own character names starting with what they have typed
+async def owned_character_autocomplete(ctx: discord.AutocompleteContext):
+    return guild_indexes(ctx.interaction.guild_id)[1].search(ctx.value or "", player=ctx.interaction.user.id)
+
 
 @bot.command(name="help", description="Displays potential commands and arguments", guild_ids=config["guild_ids"])
+@metrics.instrument
 async def help_command(ctx):
     await ctx.respond("""Everyone:
 /help - Displays this message
-/info <character name> - Lists currency for a character, discord name of owner
+/info <character name> <optional date> - Lists currency for a character, discord name of owner, optionally as of the end of a past day
 /log <character name> <optional page number> - Lists the latest page of transactions for a character with id, currency change, date, and reason
 /leaderboard <page> <optional currency to sort by> - Lists all characters by name, or by who has the most currency
+/rank <character name> <optional currency to rank by> - Shows a character's place on the leaderboard
 
 Player only:
 /create <character name> - Creates a character with the given name if it doesn't already exist
@@ -63,67 +263,148 @@ Player for only their characters and GMs for all characters:
 GMs only:
 /add <character name> <AP/RP> <amount> <reason> - Logs given currency for a character
 /remove <character name> <AP/RP> <amount> <reason> - Logs removed currency for a character
-/delete <character name> - Deletes character and all transactions associated with it
-/erase <transaction id> - Erases specific transaction and refunds currency spent on it""")
+/bulkadd <character names and/or @mentions> <AP/RP> <amount> <reason> - Logs given currency for many characters at once
+/bulkremove <character names and/or @mentions> <AP/RP> <amount> <reason> - Logs removed currency for many characters at once
+/delete <character name> <optional archive> - Deletes character and all transactions associated with it
+/erase <transaction id> - Erases specific transaction and refunds currency spent on it
+/search <words> <optional currency, user, character, since, until and page> - Finds transactions by reason, best matches first
+/economy <optional since, until and currency> - Shows currency inflow and outflow, top spenders and GMs, and the trend
+/backfill - Rebuilds the economy figures from the transaction log
+/reconcile - Checks every character's AP, RP and transaction count against the ledger
+/reload - Reloads leaderboards and character names after admin.py or ledger_io.py changed the database
+/export <characters/transactions> <optional csv/jsonl> - Uploads every character or transaction as a file
+/stats - Shows per-command latency, SQL and discord fetch statistics""")
 
 
 @bot.command(description="Gets information about a character", guild_ids=config["guild_ids"])
+@metrics.instrument
+@coalescing.shared_read()
 async def info(
         ctx,
-        char_name: Option(str, name="character")
+        char_name: Option(str, name="character", autocomplete=character_autocomplete),
+        date: Option(str, description="Show the balance at the end of this day, as YYYY-MM-DD", required=False)
 ):
-    character = database.get_character_by_name(char_name)
-    player = await bot.fetch_user(character.player)
+    if date:
+        try:
+            until = datetime.datetime.fromisoformat(date) + datetime.timedelta(days=1)
+        except ValueError:
+            await ctx.respond(f"Dates must look like 2024-01-31")
+            return
+
+        balance = await async_database.get_balance_at(ctx.guild_id, char_name, until)
+
+        if not balance:
+            await ctx.respond(f"{char_name} not found")
+            return
 
-    response = "```Name                 |  AP |    RP | Player\n"
-    response += (f"{character.name:<20} | " + f"{character.ap:>3} | " + f"{character.rp:>5} | " + f"{player.name}" + "\n")
+        character, ap, rp = balance
+    else:
+        character = await async_database.get_character_by_name(ctx.guild_id, char_name)
+
+        if not character:
+            await ctx.respond(f"{char_name} not found")
+            return
+
+        ap, rp = character.ap, character.rp
+
+    player = await names.name(character.player)
+
+    response = f"```As of the end of {date}\n" if date else "```"
+    response += "Name                 |  AP |    RP | Player\n"
+    response += (f"{character.name:<20} | " + f"{ap:>3} | " + f"{rp:>5} | " + f"{player}" + "\n")
     response += "```"
 
     await ctx.respond(response)
 
 @bot.command(description="Lists a character's transactions", guild_ids=config["guild_ids"])
+@metrics.instrument
+@coalescing.shared_read()
 async def log(
         ctx,
-        char_name: Option(str, name="character"),
+        char_name: Option(str, name="character", autocomplete=character_autocomplete),
         page: Option(int, description="Log page number", required=False, default=1)
 ):
-    transactions = database.get_character_transactions(char_name, page, config["page_size"])
-    pages = database.get_character_transaction_pages(char_name, config["page_size"])
-    response = f"```Page {page}/{pages}\nID    | Type | Amount | Date       | User                             | Reason\n"
+    character_log = await async_database.get_character_log(ctx.guild_id, char_name, page, config["page_size"])
 
-    for transaction in transactions:
-        user = await bot.fetch_user(transaction.user)
-        response += (f"{transaction.id:<5} | " + f"{transaction.currency:<4} | " +
-                     f"{transaction.amount:<6} | " + f"{transaction.date.strftime('%Y-%m-%d')} | "
-                     + f"{user.name:<32} | " + f"{transaction.reason:<32}" + "\n")
+    if not character_log:
+        await ctx.respond(f"{char_name} not found")
+        return
 
-    response += "```"
-    await ctx.respond(response)
+    _, pages = character_log
+
+    # Renders a window of pages of the log with one query and one round of name lookups
+    async def load_window(window):
+        transactions, _ = await async_database.get_character_log(ctx.guild_id, char_name, window + 1,
+                                                                 config["page_size"] * window_pages)
+        users = await names.resolve([transaction.user for transaction in transactions])
+        lines = []
+
+        for transaction in transactions:
+            user = users[transaction.user]
+            lines.append(f"{transaction.id:<5} | " + f"{transaction.currency:<4} | " +
+                         f"{transaction.amount:<6} | " + f"{transaction.date.strftime('%Y-%m-%d')} | "
+                         + f"{user:<32} | " + f"{transaction.reason:<32}" + "\n")
+
+        return lines
+
+    view = PagedView(load_window, "ID    | Type | Amount | Date       | User                             | Reason\n",
+                     pages, config["page_size"], timeout=config.get("page_view_ttl", 120))
+    await view.send(ctx, page)
 
 
 @bot.command(description="Lists all characters", guild_ids=config["guild_ids"])
+@metrics.instrument
+@coalescing.shared_read()
 async def leaderboard(
         ctx,
         page: Option(int, description="Log page number", required=False, default=1),
         currency: Option(str, choices=["AP", "RP"], description="Advancement Points or Royal Pieces", required=False),
 ):
-    characters = database.get_all_characters(page, config["page_size"], currency)
-    pages = database.get_all_character_pages(config["page_size"])
-    response = f"```Page {page}/{pages}\nName                 |  AP |    RP | Player\n"
+    guild_ranks, _ = guild_indexes(ctx.guild_id)
+    pages = math.ceil(guild_ranks.count() / config["page_size"])
 
-    for character in characters:
-        player = await bot.fetch_user(character[0].player)
-        response += (f"{character[0].name:<20} | " + f"{character[0].ap:>3} | " + f"{character[0].rp:>5} | " + f"{player.name}" + "\n")
+    # Renders a window of pages of the leaderboard with one round of name lookups
+    async def load_window(window):
+        characters = guild_ranks.page(currency, window + 1, config["page_size"] * window_pages)
+        players = await names.resolve([character.player for character in characters])
+        lines = []
 
-    response += "```"
-    await ctx.respond(response)
+        for character in characters:
+            player = players[character.player]
+            lines.append(f"{character.name:<20} | " + f"{character.ap:>3} | " + f"{character.rp:>5} | " + f"{player}" + "\n")
+
+        return lines
+
+    view = PagedView(load_window, "Name                 |  AP |    RP | Player\n", pages, config["page_size"],
+                     timeout=config.get("page_view_ttl", 120))
+    await view.send(ctx, page)
+
+
+@bot.command(description="Shows a character's place on the leaderboard", guild_ids=config["guild_ids"])
+@metrics.instrument
+@coalescing.shared_read()
+async def rank(
+        ctx,
+        char_name: Option(str, name="character", autocomplete=character_autocomplete),
+        currency: Option(str, choices=["AP", "RP"], description="Advancement Points or Royal Pieces", required=False),
+):
+    guild_ranks, _ = guild_indexes(ctx.guild_id)
+    place = guild_ranks.rank(char_name, currency)
+
+    if place is None:
+        await ctx.respond(f"{char_name} not found")
+        return
+
+    await ctx.respond(f"{char_name} is #{place} of {guild_ranks.count()} by {currency or 'name'}")
 
 @bot.command(description="Creates a new character", guild_ids=config["guild_ids"])
+@metrics.instrument
+@coalescing.idempotent
 async def create(
         ctx,
         char_name: Option(str, name="character")
 ):
-    characters = database.get_characters_by_owner(ctx.author.id)
+    characters = await async_database.get_characters_by_owner(ctx.guild_id, ctx.author.id)
 
     if len(characters) >= config["character_limit"]:
         await ctx.respond(f"The limit is {config['character_limit']} characters and you have {len(characters)} characters!")
@@ -133,17 +414,20 @@ async def create(
         await ctx.respond(f"The character name length limit is 20 characters and yours is {len(char_name)} characters!")
         return
 
-    if database.get_character_by_name(char_name):
+    if await async_database.get_character_by_name(ctx.guild_id, char_name):
         await ctx.respond(f"{char_name} already exists!")
         return
 
-    if database.create_character(char_name, ctx.author.id):
+    if await writes.create_character(ctx.guild_id, char_name, ctx.author.id):
+        coalescing.committed()
         await ctx.respond(f"Successfully created {char_name}")
     else:
         await ctx.respond(f"Failed to create {char_name}")
 
 
 @bot.command(name="list", description="Lists all of a player's characters", guild_ids=config["guild_ids"])
+@metrics.instrument
+@coalescing.shared_read(per_user=True)
 async def list_chars(
         ctx,
         player: Option(discord.User, name="player", required=False)
@@ -151,9 +435,9 @@ async def list_chars(
 
 
     if player:
-        characters = database.get_characters_by_owner(player.id)
+        characters = await async_database.get_characters_by_owner(ctx.guild_id, player.id)
     else:
-        characters = database.get_characters_by_owner(ctx.author.id)
+        characters = await async_database.get_characters_by_owner(ctx.guild_id, ctx.author.id)
     response = "```Name                 |  AP |    RP \n"
 
     for character in characters:
@@ -164,9 +448,11 @@ async def list_chars(
 
 
 @bot.command(description="Creates a new character", guild_ids=config["guild_ids"])
+@metrics.instrument
+@coalescing.idempotent
 async def buy(
         ctx,
-        char_name: Option(str, name="character"),
+        char_name: Option(str, name="character", autocomplete=owned_character_autocomplete),
         currency: Option(str, choices=["AP", "RP"], description="Advancement Points or Royal Pieces"),
         amount: Option(int, description="Amount you are spending"),
         reason: Option(str, description="What you are spending it on"),
@@ -178,7 +464,7 @@ async def buy(
         if role.id in config["gm_roles"]:
             gm = True
 
-    character = database.get_character_by_name(char_name)
+    character = await async_database.get_character_by_name(ctx.guild_id, char_name)
     if character and character.player == ctx.author.id:
         owned = True
 
@@ -190,21 +476,21 @@ async def buy(
         await ctx.respond(f"No stealing from the kingdom!")
         return
 
-    if currency == "AP" and character.ap - amount < 0:
-        await ctx.respond(f"Not enough AP!")
-        return
+    result = await writes.apply_transaction(ctx.guild_id, character.name, ctx.author.id, currency, (amount * -1),
+                                            reason)
 
-    if currency == "RP" and character.rp - amount < 0:
-        await ctx.respond(f"Not enough RP!")
-        return
-
-    if database.do_transaction(character.name, ctx.author.id, currency, (amount * -1), reason):
+    if result == database.TRANSACTION_INSUFFICIENT:
+        await ctx.respond(f"Not enough {currency}!")
+    elif result == database.TRANSACTION_DONE:
+        coalescing.committed()
         await ctx.respond(f"{char_name} bought {reason} for {amount} {currency}")
     else:
         await ctx.respond(f"{char_name} failed to buy {reason} for {amount} {currency}")
 
 
 @bot.command(description="Refunds a given transaction", guild_ids=config["guild_ids"])
+@metrics.instrument
+@coalescing.idempotent
 async def refund(
         ctx,
         transaction_id: Option(int, name="transaction", description="Transaction id number to refund"),
@@ -216,7 +502,7 @@ async def refund(
         if role.id in config["gm_roles"]:
             gm = True
 
-    character = database.get_character_by_transaction_id(transaction_id)
+    character = await async_database.get_character_by_transaction_id(ctx.guild_id, transaction_id)
     if character and character.player == ctx.author.id:
         owned = True
 
@@ -224,23 +510,26 @@ async def refund(
         await ctx.respond(f"Begone player!")
         return
 
-    transaction = database.get_transaction_by_id(transaction_id)
+    transaction = await async_database.get_transaction_by_id(ctx.guild_id, transaction_id)
 
     if not transaction:
         await ctx.respond(f"Transaction {transaction_id} not found")
         return
 
-    if database.do_transaction(character.name, ctx.author.id, transaction.currency, (transaction.amount * -1),
-                               f"Refunded transaction {transaction_id}"):
+    if await writes.do_transaction(ctx.guild_id, character.name, ctx.author.id, transaction.currency,
+                                   (transaction.amount * -1), f"Refunded transaction {transaction_id}"):
+        coalescing.committed()
         await ctx.respond(f"Refunded transaction {transaction_id}")
     else:
         await ctx.respond(f"Failed to refund transaction {transaction_id}")
 
 
 @bot.command(description="Adds currency to a character", guild_ids=config["guild_ids"])
+@metrics.instrument
+@coalescing.idempotent
 async def add(
         ctx,
-        char_name: Option(str, name="character"),
+        char_name: Option(str, name="character", autocomplete=character_autocomplete),
         currency: Option(str, choices=["AP", "RP"], description="Advancement Points or Royal Pieces"),
         amount: Option(int, description="Amount you are spending"),
         reason: Option(str, description="What you are spending it on"),
@@ -256,7 +545,7 @@ async def add(
         await ctx.respond(f"Begone player!")
         return
 
-    if not database.get_character_by_name(char_name):
+    if not await async_database.get_character_by_name(ctx.guild_id, char_name):
         await ctx.respond(f"{char_name} not found")
         return
 
@@ -264,16 +553,19 @@ async def add(
         await ctx.respond(f"No stealing from the kingdom!")
         return
 
-    if database.do_transaction(char_name, ctx.author.id, currency, amount, reason):
+    if await writes.do_transaction(ctx.guild_id, char_name, ctx.author.id, currency, amount, reason):
+        coalescing.committed()
         await ctx.respond(f"Added {amount} {currency} to {char_name}")
     else:
         await ctx.respond(f"Failed to add {amount} {currency} to {char_name}")
 
 
 @bot.command(description="Removes currency from a character", guild_ids=config["guild_ids"])
+@metrics.instrument
+@coalescing.idempotent
 async def remove(
         ctx,
-        char_name: Option(str, name="character"),
+        char_name: Option(str, name="character", autocomplete=character_autocomplete),
         currency: Option(str, choices=["AP", "RP"], description="Advancement Points or Royal Pieces"),
         amount: Option(int, description="Amount you are spending"),
         reason: Option(str, description="What you are spending it on"),
@@ -289,7 +581,7 @@ async def remove(
         await ctx.respond(f"Begone player!")
         return
 
-    character = database.get_character_by_name(char_name)
+    character = await async_database.get_character_by_name(ctx.guild_id, char_name)
 
     if not character:
         await ctx.respond(f"{char_name} not found")
@@ -299,24 +591,140 @@ async def remove(
         await ctx.respond(f"No stealing from the kingdom!")
         return
 
-    if currency == "AP" and character.ap - amount < 0:
-        await ctx.respond(f"Not enough AP!")
-        return
+    result = await writes.apply_transaction(ctx.guild_id, char_name, ctx.author.id, currency, (amount * -1), reason)
 
-    if currency == "RP" and character.rp - amount < 0:
-        await ctx.respond(f"Not enough RP!")
-        return
-
-    if database.do_transaction(char_name, ctx.author.id, currency, (amount * -1), reason):
+    if result == database.TRANSACTION_INSUFFICIENT:
+        await ctx.respond(f"Not enough {currency}!")
+    elif result == database.TRANSACTION_DONE:
+        coalescing.committed()
         await ctx.respond(f"Removed {amount} {currency} from {char_name}")
     else:
         await ctx.respond(f"Failed to remove {amount} {currency} from {char_name}")
 
 
+# Splits a bulk target list into character names and the ids of mentioned players, expanding role mentions.
+# Returns the names, the player ids and the names of mentioned roles that had no members.
+async def parse_targets(ctx, targets):
+    players = {int(user_id) for user_id in re.findall(r"<@!?(\d+)>", targets)}
+    empty_roles = []
+
+    for role_id in re.findall(r"<@&(\d+)>", targets):
+        role = ctx.guild.get_role(int(role_id)) if ctx.guild else None
+
+        # Members are cached when the bot starts, but a guild joined since may not be loaded yet
+        if role and bot.intents.members and not ctx.guild.chunked:
+            await ctx.defer()
+            await ctx.guild.chunk()
+
+        if role and role.members:
+            players.update(member.id for member in role.members)
+        else:
+            empty_roles.append(f"@{role.name}" if role else role_id)
+
+    names = [name.strip() for name in re.sub(r"<@[!&]?\d+>", ",", targets).split(",") if name.strip()]
+    return names, list(players), empty_roles
+
+
+# Applies one transaction to every targeted character and responds with a single summary
+async def bulk_transaction(ctx, targets, currency, amount, reason):
+    names, players, empty_roles = await parse_targets(ctx, targets)
+    roles_note = ""
+
+    if empty_roles:
+        roles_note = f"\nNo members found in {', '.join(empty_roles)}"
+
+        if not bot.intents.members:
+            roles_note += " (role mentions need members_intent in the config)"
+
+    if not names and not players:
+        await ctx.respond(f"No characters given!" + roles_note)
+        return
+
+    result = await async_database.do_bulk_transaction(ctx.guild_id, names, players, ctx.author.id, currency, amount,
+                                                      reason)
+
+    if not result:
+        await ctx.respond(f"Failed to change {currency} for {targets}")
+        return
+
+    changed, missing, insufficient = result
+
+    if changed:
+        coalescing.committed()
+
+    action = f"Added {amount} {currency} to" if amount >= 0 else f"Removed {amount * -1} {currency} from"
+    response = f"{action} {len(changed)} characters: {', '.join(changed)}"
+
+    if missing:
+        response += f"\nNot found: {', '.join(missing)}"
+
+    if insufficient:
+        response += f"\nNot enough {currency}: {', '.join(insufficient)}"
+
+    await ctx.respond(response[:2000 - len(roles_note)] + roles_note)
+
+
+@bot.command(description="Adds currency to many characters", guild_ids=config["guild_ids"])
+@metrics.instrument
+@coalescing.idempotent
+async def bulkadd(
+        ctx,
+        targets: Option(str, name="characters", description="Comma separated character names and/or @mentions"),
+        currency: Option(str, choices=["AP", "RP"], description="Advancement Points or Royal Pieces"),
+        amount: Option(int, description="Amount each character gets"),
+        reason: Option(str, description="What they are getting it for"),
+):
+    gm = False
+
+    for role in ctx.author.roles:
+        if role.id in config["gm_roles"]:
+            gm = True
+
+    if not gm:
+        await ctx.respond(f"Begone player!")
+        return
+
+    if amount < 0:
+        await ctx.respond(f"No stealing from the kingdom!")
+        return
+
+    await bulk_transaction(ctx, targets, currency, amount, reason)
+
+
+@bot.command(description="Removes currency from many characters", guild_ids=config["guild_ids"])
+@metrics.instrument
+@coalescing.idempotent
+async def bulkremove(
+        ctx,
+        targets: Option(str, name="characters", description="Comma separated character names and/or @mentions"),
+        currency: Option(str, choices=["AP", "RP"], description="Advancement Points or Royal Pieces"),
+        amount: Option(int, description="Amount removed from each character"),
+        reason: Option(str, description="What it is being removed for"),
+):
+    gm = False
+
+    for role in ctx.author.roles:
+        if role.id in config["gm_roles"]:
+            gm = True
+
+    if not gm:
+        await ctx.respond(f"Begone player!")
+        return
+
+    if amount < 0:
+        await ctx.respond(f"No stealing from the kingdom!")
+        return
+
+    await bulk_transaction(ctx, targets, currency, (amount * -1), reason)
+
+
 @bot.command(description="Deletes a character. THIS CANNOT BE UNDONE", guild_ids=config["guild_ids"])
+@metrics.instrument
+@coalescing.idempotent
 async def delete(
         ctx,
-        char_name: Option(str, name="character")
+        char_name: Option(str, name="character", autocomplete=character_autocomplete),
+        archive: Option(bool, description="Keep the transactions in the archive", required=False, default=False),
 ):
 
     gm = False
@@ -329,17 +737,27 @@ async def delete(
         await ctx.respond(f"Begone player!")
         return
 
-    if not database.get_character_by_name(char_name):
+    character = await async_database.get_character_by_name(ctx.guild_id, char_name)
+
+    if not character:
         await ctx.respond(f"{char_name} not found")
         return
 
-    if database.delete_character(char_name):
-        await ctx.respond(f"Deleted {char_name}")
+    if await async_database.delete_character(ctx.guild_id, char_name, archive):
+        coalescing.committed()
+        await ctx.respond(f"Deleted {char_name}, removing {character.transaction_count} transactions")
+
+        async def report(content):
+            await ctx.interaction.edit_original_response(content=content)
+
+        bot.loop.create_task(purge_transactions(character.id, character.name, character.transaction_count, report))
     else:
         await ctx.respond(f"Failed to delete {char_name}")
 
 
 @bot.command(description="Erases transaction and refunds currency gain/loss", guild_ids=config["guild_ids"])
+@metrics.instrument
+@coalescing.idempotent
 async def erase(
         ctx,
         transaction: Option(int, description="Transaction id number to erase"),
@@ -354,16 +772,238 @@ async def erase(
         await ctx.respond(f"Begone player!")
         return
 
-    if not database.get_transaction_by_id(transaction):
+    if not await async_database.get_transaction_by_id(ctx.guild_id, transaction):
         await ctx.respond(f"{transaction} not found")
         return
 
-    if database.erase_transaction(transaction):
+    if await writes.erase_transaction(ctx.guild_id, transaction):
+        coalescing.committed()
         await ctx.respond(f"Erased {transaction}")
     else:
         await ctx.respond(f"Failed to erase {transaction}")
 
 
+@bot.command(description="Searches transaction reasons", guild_ids=config["guild_ids"])
+@metrics.instrument
+async def search(
+        ctx,
+        words: Option(str, description="Words in the reason, the last one can be the start of a word"),
+        currency: Option(str, choices=["AP", "RP"], description="Advancement Points or Royal Pieces", required=False),
+        user: Option(discord.User, description="Who logged the transaction", required=False),
+        char_name: Option(str, name="character", autocomplete=character_autocomplete, required=False),
+        since: Option(str, description="First date as YYYY-MM-DD", required=False),
+        until: Option(str, description="Last date as YYYY-MM-DD", required=False),
+        page: Option(int, description="Results page number", required=False, default=1),
+):
+    gm = False
+
+    for role in ctx.author.roles:
+        if role.id in config["gm_roles"]:
+            gm = True
+
+    if not gm:
+        await ctx.respond(f"Begone player!")
+        return
+
+    try:
+        since = datetime.datetime.fromisoformat(since) if since else None
+        until = datetime.datetime.fromisoformat(until) + datetime.timedelta(days=1) if until else None
+    except ValueError:
+        await ctx.respond(f"Dates must look like 2024-01-31")
+        return
+
+    filters = {"currency": currency, "user": user.id if user else None, "character_name": char_name,
+               "since": since, "until": until}
+    results = await async_database.search_transactions(ctx.guild_id, words, page, config["page_size"], **filters)
+
+    if results is False:
+        await ctx.respond(f"{char_name} not found")
+        return
+
+    _, pages = results
+
+    if not pages:
+        await ctx.respond(f"No transactions match {words}")
+        return
+
+    # Renders a window of pages of results with one query and one round of name lookups
+    async def load_window(window):
+        rows, _ = await async_database.search_transactions(ctx.guild_id, words, window + 1,
+                                                           config["page_size"] * window_pages, **filters)
+        users = await names.resolve([transaction.user for transaction, _ in rows])
+        lines = []
+
+        for transaction, character in rows:
+            user_name = users[transaction.user]
+            lines.append(f"{transaction.id:<5} | " + f"{character:<20} | " + f"{transaction.currency:<4} | " +
+                         f"{transaction.amount:<6} | " + f"{transaction.date.strftime('%Y-%m-%d')} | "
+                         + f"{user_name:<32} | " + f"{transaction.reason:<32}" + "\n")
+
+        return lines
+
+    header = "ID    | Character            | Type | Amount | Date       | User                             | Reason\n"
+    view = PagedView(load_window, header, pages, config["page_size"], timeout=config.get("page_view_ttl", 120))
+    await view.send(ctx, page)
+
+
+@bot.command(description="Shows how currency flows through the economy", guild_ids=config["guild_ids"])
+@metrics.instrument
+async def economy(
+        ctx,
+        since: Option(str, description="First date as YYYY-MM-DD, 30 days ago by default", required=False),
+        until: Option(str, description="Last date as YYYY-MM-DD, today by default", required=False),
+        currency: Option(str, choices=["AP", "RP"], description="Advancement Points or Royal Pieces", required=False),
+):
+    gm = False
+
+    for role in ctx.author.roles:
+        if role.id in config["gm_roles"]:
+            gm = True
+
+    if not gm:
+        await ctx.respond(f"Begone player!")
+        return
+
+    try:
+        until = datetime.date.fromisoformat(until) if until else datetime.datetime.now(datetime.timezone.utc).date()
+        since = datetime.date.fromisoformat(since) if since else until - datetime.timedelta(days=30)
+    except ValueError:
+        await ctx.respond(f"Dates must look like 2024-01-31")
+        return
+
+    totals, spenders, givers, trend = await async_database.get_economy(ctx.guild_id, since, until, currency)
+    users = await names.resolve([user for user, _ in givers])
+
+    response = f"```Economy from {since} to {until}\n"
+    response += "Type | Inflow | Outflow |    Net | Transactions\n"
+
+    for total_currency, inflow, outflow, count in totals:
+        response += (f"{total_currency:<4} | " + f"{inflow:>6} | " + f"{outflow:>7} | " + f"{inflow - outflow:>6} | "
+                     + f"{count:>12}" + "\n")
+
+    response += "\nTop spenders: " + (", ".join(f"{name} ({outflow})" for name, outflow in spenders) or "none")
+    response += "\nTop givers: " + (", ".join(f"{users[user]} ({inflow})" for user, inflow in givers) or "none")
+    response += "\n\nPeriod     | Inflow | Outflow |    Net\n"
+
+    for period, inflow, outflow in trend:
+        response += f"{period:<10} | " + f"{inflow:>6} | " + f"{outflow:>7} | " + f"{inflow - outflow:>6}" + "\n"
+
+    await ctx.respond(response[:1997] + "```")
+
+
+@bot.command(description="Rebuilds the economy figures from the transaction log", guild_ids=config["guild_ids"])
+@metrics.instrument
+async def backfill(ctx):
+    gm = False
+
+    for role in ctx.author.roles:
+        if role.id in config["gm_roles"]:
+            gm = True
+
+    if not gm:
+        await ctx.respond(f"Begone player!")
+        return
+
+    await ctx.defer()
+
+    if await async_database.backfill_rollups(ctx.guild_id):
+        await ctx.respond(f"Rebuilt the economy figures")
+    else:
+        await ctx.respond(f"Failed to rebuild the economy figures")
+
+
+@bot.command(description="Checks every character's balances against the ledger", guild_ids=config["guild_ids"])
+@metrics.instrument
+async def reconcile(ctx):
+    gm = False
+
+    for role in ctx.author.roles:
+        if role.id in config["gm_roles"]:
+            gm = True
+
+    if not gm:
+        await ctx.respond(f"Begone player!")
+        return
+
+    await ctx.defer()
+    drift = await async_database.reconcile_balances(ctx.guild_id)
+
+    if not drift:
+        await ctx.respond(f"Every balance matches the ledger")
+        return
+
+    response = "```Name                 | What         | Stored | Ledger\n"
+
+    for _, name, what, stored, expected in drift:
+        response += f"{name:<20} | " + f"{what:<12} | " + f"{stored:>6} | " + f"{expected:>6}" + "\n"
+
+    await ctx.respond(response[:1997] + "```")
+
+
+@bot.command(description="Reloads leaderboards and character names from the database", guild_ids=config["guild_ids"])
+@metrics.instrument
+async def reload(ctx):
+    gm = False
+
+    for role in ctx.author.roles:
+        if role.id in config["gm_roles"]:
+            gm = True
+
+    if not gm:
+        await ctx.respond(f"Begone player!")
+        return
+
+    load_guild_indexes(await async_database.get_character_standings())
+    await ctx.respond(f"Reloaded leaderboards and character names")
+
+
+@bot.command(description="Exports every character or transaction as a file", guild_ids=config["guild_ids"])
+@metrics.instrument
+async def export(
+        ctx,
+        table: Option(str, choices=["characters", "transactions"], description="What to export"),
+        file_format: Option(str, name="format", choices=["csv", "jsonl"], description="File format",
+                            required=False, default="csv"),
+):
+    gm = False
+
+    for role in ctx.author.roles:
+        if role.id in config["gm_roles"]:
+            gm = True
+
+    if not gm:
+        await ctx.respond(f"Begone player!")
+        return
+
+    await ctx.defer()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, f"{table}.{file_format}")
+        count = await async_database.export_table(table, path, file_format, guild_id=ctx.guild_id)
+
+        if ctx.guild and os.path.getsize(path) > ctx.guild.filesize_limit:
+            await ctx.respond(f"The {table} export is too large to upload, use ledger_io.py instead")
+            return
+
+        await ctx.respond(f"Exported {count} {table}", file=discord.File(path))
+
+
+@bot.command(description="Shows per-command latency and query statistics", guild_ids=config["guild_ids"])
+@metrics.instrument
+async def stats(ctx):
+    gm = False
+
+    for role in ctx.author.roles:
+        if role.id in config["gm_roles"]:
+            gm = True
+
+    if not gm:
+        await ctx.respond(f"Begone player!")
+        return
+
+    await ctx.respond(f"```{metrics.render_table()}```"[:2000])
+
+
 def main():
     bot.run(config["token"])
 
@@ -0,0 +1,151 @@
+# Load standard libraries
+import argparse
+import csv
+import datetime
+import json
+from itertools import chain, islice
+
+# Load project files
+import database
+
+# Columns written and read for each table
+columns = {
+    "characters": ["id", "guild_id", "name", "player", "ap", "rp"],
+    "transactions": ["id", "guild_id", "character", "currency", "amount", "user", "reason", "date"],
+}
+
+# Supported file formats
+formats = ["csv", "jsonl"]
+
+
+# Guess the file format from the file extension
+def format_from_path(path):
+    return "jsonl" if str(path).endswith((".jsonl", ".json")) else "csv"
+
+
+# Turn a database row or dict into plain values that csv and json can write
+def export_values(row):
+    values = row if isinstance(row, dict) else row._asdict()
+    return {key: value.isoformat() if isinstance(value, datetime.datetime) else value
+            for key, value in values.items()}
+
+
+# Stream a whole table, or one guild's part of it, to a file without holding it in memory,
+# returning the number of rows written
+def export_table(table, path, file_format=None, batch_size=1000, guild_id=None):
+    file_format = file_format or format_from_path(path)
+    rows = database.stream_characters(batch_size, guild_id) if table == "characters" else \
+        chain(database.stream_transactions(batch_size, guild_id), database.stream_archived_transactions(guild_id))
+    count = 0
+
+    with open(path, "w", newline="", encoding="utf-8") as file:
+        if file_format == "csv":
+            writer = csv.DictWriter(file, fieldnames=columns[table])
+            writer.writeheader()
+
+        for row in rows:
+            if file_format == "csv":
+                writer.writerow(export_values(row))
+            else:
+                file.write(json.dumps(export_values(row)) + "\n")
+
+            count += 1
+
+    return count
+
+
+# Read rows from a csv or jsonl file one at a time
+def read_rows(path, file_format=None):
+    file_format = file_format or format_from_path(path)
+
+    with open(path, newline="", encoding="utf-8") as file:
+        if file_format == "csv":
+            yield from csv.DictReader(file)
+        else:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+# Convert a row read from a file into the values the database import expects, using the given guild for rows
+# that don't name one. Characters start at zero unless with_balances is set.
+def import_values(table, row, guild_id=None, with_balances=False):
+    guild_id = int(row.get("guild_id") or guild_id or 0)
+
+    if not guild_id:
+        raise ValueError(f"No guild given for {row}")
+
+    if table == "characters":
+        return {"guild_id": guild_id, "name": row["name"], "player": int(row["player"]),
+                "ap": int(row.get("ap") or 0) if with_balances else 0,
+                "rp": int(row.get("rp") or 0) if with_balances else 0}
+
+    date = row.get("date")
+    return {"guild_id": guild_id, "character": row["character"], "currency": row["currency"].upper(),
+            "amount": int(row["amount"]), "user": int(row["user"]) if row.get("user") else None,
+            "reason": row.get("reason") or "",
+            "date": datetime.datetime.fromisoformat(date) if date else datetime.datetime.now(datetime.timezone.utc)}
+
+
+# Load a file into a table in chunks with one commit per chunk, calling progress(rows done) after each.
+# Rows without a guild_id go to the given guild.
+# Imported transactions are added to the balances, so the ledger is the source of truth and characters start at
+# zero. with_balances keeps the exported balances instead, for characters imported without their transactions.
+# Returns the number of rows imported and the names of characters that were missing.
+def import_table(table, path, file_format=None, chunk_size=500, progress=None, guild_id=None, with_balances=False):
+    rows = (import_values(table, row, guild_id, with_balances) for row in read_rows(path, file_format))
+    imported = 0
+    done = 0
+    missing = set()
+
+    while chunk := list(islice(rows, chunk_size)):
+        if table == "characters":
+            result = database.import_characters(chunk)
+        else:
+            result = database.import_transactions(chunk)
+
+        if result is False:
+            raise RuntimeError(f"Failed to import rows {done + 1} to {done + len(chunk)}")
+
+        if table == "characters":
+            imported += result
+        else:
+            imported += result[0]
+            missing.update(result[1])
+
+        done += len(chunk)
+        if progress:
+            progress(done)
+
+    return imported, sorted(missing)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or import keeper.db characters and transactions")
+    parser.add_argument("action", choices=["export", "import"])
+    parser.add_argument("table", choices=list(columns))
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=formats, help="File format, guessed from the extension by default")
+    parser.add_argument("--chunk-size", type=int, default=500, help="Rows per batch")
+    parser.add_argument("--guild", type=int, help="Only export this guild, or import rows without a guild_id into it")
+    parser.add_argument("--with-balances", action="store_true",
+                        help="Import characters with their AP and RP. By default they start at zero and get their "
+                             "balances from importing the transactions, which adds every amount to them.")
+    args = parser.parse_args()
+
+    if args.action == "export":
+        count = export_table(args.table, args.path, args.format, args.chunk_size, args.guild)
+        print(f"Exported {count} {args.table} to {args.path}")
+    else:
+        imported, missing = import_table(args.table, args.path, args.format, args.chunk_size,
+                                         lambda done: print(f"Read {done} rows"), args.guild, args.with_balances)
+        print(f"Imported {imported} {args.table} from {args.path}")
+
+        if missing:
+            print(f"Characters not found: {', '.join(missing)}")
+
+        print("Use /reload in discord, or restart the bot, so its leaderboards and character names catch up")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+# Load standard libraries
+import asyncio
+import contextvars
+import functools
+import logging
+import threading
+import time
+
+from sqlalchemy import event
+
+# Upper bounds of the latency histogram buckets in seconds
+buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, float("inf")]
+
+# Work done by the interaction currently running, carried into database worker threads
+current = contextvars.ContextVar("current_interaction", default=None)
+
+slow_query_log = logging.getLogger("kindred_keeper.slow_queries")
+lock = threading.Lock()
+
+
+# Latency histogram and query and fetch totals for one command
+class CommandStats:
+    def __init__(self):
+        self.counts = [0] * len(buckets)
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.fetches = 0
+        self.fetch_seconds = 0.0
+
+    # Add one finished interaction
+    def add(self, seconds, interaction, failed):
+        self.calls += 1
+        self.errors += failed
+        self.seconds += seconds
+        self.queries += interaction["queries"]
+        self.query_seconds += interaction["query_seconds"]
+        self.fetches += interaction["fetches"]
+        self.fetch_seconds += interaction["fetch_seconds"]
+
+        for index, bound in enumerate(buckets):
+            if seconds <= bound:
+                self.counts[index] += 1
+                break
+
+    # Estimate a latency percentile from the histogram, as the upper bound of the bucket it falls in
+    def percentile(self, fraction):
+        target = self.calls * fraction
+        seen = 0
+
+        for bound, count in zip(buckets, self.counts):
+            seen += count
+            if count and seen >= target:
+                return bound
+
+        return 0
+
+
+commands = {}
+totals = {"queries": 0, "query_seconds": 0.0, "fetches": 0, "fetch_seconds": 0.0}
+slow_query_seconds = None
+
+
+# Start counting work for a new interaction
+def new_interaction():
+    return {"queries": 0, "query_seconds": 0.0, "fetches": 0, "fetch_seconds": 0.0}
+
+
+# Add work to the running interaction and the process totals
+def record(count_key, seconds_key, seconds):
+    interaction = current.get()
+
+    with lock:
+        totals[count_key] += 1
+        totals[seconds_key] += seconds
+
+        if interaction is not None:
+            interaction[count_key] += 1
+            interaction[seconds_key] += seconds
+
+
+# Wrap a slash command handler so its latency, SQL statements and discord fetches are recorded under its name
+def instrument(function):
+    @functools.wraps(function)
+    async def wrapper(ctx, *args, **kwargs):
+        interaction = new_interaction()
+        token = current.set(interaction)
+        start = time.perf_counter()
+        failed = True
+
+        try:
+            result = await function(ctx, *args, **kwargs)
+            failed = False
+            return result
+        finally:
+            seconds = time.perf_counter() - start
+            current.reset(token)
+
+            with lock:
+                commands.setdefault(function.__name__, CommandStats()).add(seconds, interaction, failed)
+
+    return wrapper
+
+
+# Time a discord API fetch for the running interaction
+async def timed_fetch(awaitable):
+    start = time.perf_counter()
+
+    try:
+        return await awaitable
+    finally:
+        record("fetches", "fetch_seconds", time.perf_counter() - start)
+
+
+# Hook engine events to count and time every SQL statement, logging those slower than the threshold
+def install(engine, slow_query_ms=None):
+    global slow_query_seconds
+    slow_query_seconds = slow_query_ms / 1000 if slow_query_ms else None
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - connection.info["query_start"].pop()
+        record("queries", "query_seconds", seconds)
+
+        if slow_query_seconds is not None and seconds >= slow_query_seconds:
+            slow_query_log.warning("%.1fms: %s", seconds * 1000, " ".join(statement.split()))
+
+
+# Render a table of per-command stats for the /stats command
+def render_table():
+    with lock:
+        rows = sorted(commands.items(), key=lambda item: -item[1].seconds)
+        response = "Command      | Calls |  p50 ms |  p99 ms | SQL/call | SQL ms/call | Fetch ms/call\n"
+
+        for name, stats in rows:
+            response += (f"{name:<12} | " + f"{stats.calls:>5} | " + f"{stats.percentile(0.5) * 1000:>7g} | "
+                         + f"{stats.percentile(0.99) * 1000:>7g} | " + f"{stats.queries / stats.calls:>8.1f} | "
+                         + f"{stats.query_seconds * 1000 / stats.calls:>11.2f} | "
+                         + f"{stats.fetch_seconds * 1000 / stats.calls:>13.2f}" + "\n")
+
+        response += (f"\nTotal: {totals['queries']} SQL statements in {totals['query_seconds']:.2f}s, "
+                     + f"{totals['fetches']} discord fetches in {totals['fetch_seconds']:.2f}s")
+
+    return response
+
+
+# Render every metric in the Prometheus text exposition format
+def render_prometheus():
+    lines = [
+        "# TYPE keeper_command_seconds histogram",
+    ]
+
+    with lock:
+        for name, stats in sorted(commands.items()):
+            seen = 0
+
+            for bound, count in zip(buckets, stats.counts):
+                seen += count
+                label = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(f'keeper_command_seconds_bucket{{command="{name}",le="{label}"}} {seen}')
+
+            lines.append(f'keeper_command_seconds_sum{{command="{name}"}} {stats.seconds}')
+            lines.append(f'keeper_command_seconds_count{{command="{name}"}} {stats.calls}')
+
+        for metric, kind, attribute in [("keeper_command_errors_total", "counter", "errors"),
+                                        ("keeper_command_queries_total", "counter", "queries"),
+                                        ("keeper_command_query_seconds_total", "counter", "query_seconds"),
+                                        ("keeper_command_fetches_total", "counter", "fetches"),
+                                        ("keeper_command_fetch_seconds_total", "counter", "fetch_seconds")]:
+            lines.append(f"# TYPE {metric} {kind}")
+
+            for name, stats in sorted(commands.items()):
+                lines.append(f'{metric}{{command="{name}"}} {getattr(stats, attribute)}')
+
+        lines.append("# TYPE keeper_queries_total counter")
+        lines.append(f"keeper_queries_total {totals['queries']}")
+        lines.append("# TYPE keeper_query_seconds_total counter")
+        lines.append(f"keeper_query_seconds_total {totals['query_seconds']}")
+        lines.append("# TYPE keeper_fetches_total counter")
+        lines.append(f"keeper_fetches_total {totals['fetches']}")
+        lines.append("# TYPE keeper_fetch_seconds_total counter")
+        lines.append(f"keeper_fetch_seconds_total {totals['fetch_seconds']}")
+
+    return "\n".join(lines) + "\n"
+
+
+# Write the Prometheus metrics to a file every interval seconds, for a node exporter textfile collector
+async def write_prometheus_file(path, interval=15):
+    while True:
+        with open(path, "w") as file:
+            file.write(render_prometheus())
+
+        await asyncio.sleep(interval)
+
+
+# Serve the Prometheus metrics over plain HTTP on a local port
+async def serve_prometheus(port, host="127.0.0.1"):
+    async def handle(reader, writer):
+        await reader.readline()
+        body = render_prometheus().encode()
+        writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                     + f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+        await writer.drain()
+        writer.close()
+
+    return await asyncio.start_server(handle, host, port)
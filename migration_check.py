@@ -0,0 +1,108 @@
+# Load standard libraries
+import argparse
+import datetime
+import importlib
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+from pathlib import Path
+
+# Tables as the first release of the bot created them, before any migration existed
+baseline_schema = [
+    """CREATE TABLE character (
+        id INTEGER NOT NULL, name VARCHAR(100), ap INTEGER, rp INTEGER, player INTEGER,
+        PRIMARY KEY (id), UNIQUE (name))""",
+    """CREATE TABLE "transaction" (
+        id INTEGER NOT NULL, character_id INTEGER, amount INTEGER, currency VARCHAR, user INTEGER,
+        reason VARCHAR(100), date DATETIME,
+        PRIMARY KEY (id), FOREIGN KEY(character_id) REFERENCES character (id) ON DELETE CASCADE)""",
+]
+
+
+# Build a database with the baseline schema and a small ledger whose balances match its transactions
+def build_baseline(path, characters=20, transactions=500, seed=1):
+    rng = random.Random(seed)
+    balances = {index: {"AP": 0, "RP": 0} for index in range(1, characters + 1)}
+    start = datetime.datetime(2024, 1, 1)
+    rows = []
+
+    for index in range(1, transactions + 1):
+        character_id = rng.randint(1, characters)
+        currency = rng.choice(["AP", "RP"])
+        amount = rng.randint(1, 20)
+        balances[character_id][currency] += amount
+        rows.append((index, character_id, amount, currency, rng.randint(1, 5), f"Quest reward {index}",
+                     (start + datetime.timedelta(hours=index)).isoformat(" ")))
+
+    with sqlite3.connect(path) as connection:
+        for statement in baseline_schema:
+            connection.execute(statement)
+
+        connection.executemany("INSERT INTO character VALUES (?, ?, ?, ?, ?)",
+                               [(index, f"Character {index}", balance["AP"], balance["RP"], index % 5 + 1)
+                                for index, balance in balances.items()])
+        connection.executemany('INSERT INTO "transaction" VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    return characters, transactions
+
+
+# Import the database module on the given file, which runs every migration, and list what doesn't hold afterwards
+def check_upgrade(path, characters, transactions, guild_id=1):
+    os.environ["KEEPER_DATABASE_URL"] = f"sqlite:///{Path(path).resolve()}"
+    database = importlib.import_module("database")
+    from sqlalchemy import func, select
+
+    session = database.session
+    problems = []
+
+    def expect(what, actual, expected):
+        if actual != expected:
+            problems.append(f"{what}: expected {expected}, got {actual}")
+
+    expect("schema version", session.execute(select(func.max(database.SchemaVersion.version))).scalar(),
+           database.migrations[-1][0])
+    expect("unassigned characters", database.get_counter(database.character_counter(0)), characters)
+    expect("claimed characters", database.claim_unassigned(guild_id), characters)
+    expect("guild character counter", database.get_counter(database.character_counter(guild_id)), characters)
+    expect("transaction counts", session.execute(select(func.sum(database.Character.transaction_count))).scalar(),
+           transactions)
+    expect("rolled up transactions", session.execute(select(func.sum(database.DailyRollup.count))).scalar(),
+           transactions)
+    expect("checkpoints", session.execute(select(func.count()).select_from(database.BalanceCheckpoint)).scalar(),
+           characters)
+    expect("balance drift", database.reconcile_balances(guild_id), [])
+
+    found = database.search_transactions(guild_id, "quest", 1, 10)
+    expect("search pages", found and found[1], -(-transactions // 10))
+
+    expect("new character", database.create_character(guild_id, "Newcomer", 1), True)
+    expect("new transaction", database.do_transaction(guild_id, "Newcomer", 1, "AP", 5, "Welcome"), True)
+    database.session.remove()
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Upgrade a baseline-schema database through every migration")
+    parser.add_argument("--path", help="Where to build the database, a temporary file by default")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(args.path or Path(directory) / "baseline.db")
+
+        if path.exists():
+            path.unlink()
+
+        characters, transactions = build_baseline(path)
+        problems = check_upgrade(path, characters, transactions)
+
+    for problem in problems:
+        print(problem)
+
+    print("Upgrade failed" if problems else "Upgraded a baseline database through every migration")
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# Load standard libraries
+import threading
+from bisect import bisect_left, insort
+
+# Most suggestions discord will show for an autocomplete option
+max_suggestions = 25
+
+
+# Case-insensitive prefix index over character names, kept as a sorted list for bisect lookups
+class NameIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = []
+        self.characters = {}
+        self.players = {}
+
+    # Replace the whole index with the given characters
+    def load(self, characters):
+        with self.lock:
+            self.characters = {character.id: (character.name.lower(), character.name, character.id,
+                                              character.player) for character in characters}
+            self.entries = sorted(self.characters.values())
+            self.players = {}
+
+            for entry in self.entries:
+                self.players.setdefault(entry[3], []).append(entry)
+
+    # Take a character out of the index
+    def discard(self, character_id):
+        entry = self.characters.pop(character_id, None)
+
+        if entry:
+            index = bisect_left(self.entries, entry)
+            if index < len(self.entries) and self.entries[index] == entry:
+                del self.entries[index]
+
+            owned = self.players.get(entry[3], [])
+            if entry in owned:
+                owned.remove(entry)
+
+    # Apply changed and deleted characters after a commit
+    def update(self, changed, deleted=()):
+        with self.lock:
+            for character_id in deleted:
+                self.discard(character_id)
+
+            for character in changed:
+                entry = (character.name.lower(), character.name, character.id, character.player)
+
+                if self.characters.get(character.id) == entry:
+                    continue
+
+                self.discard(character.id)
+                self.characters[character.id] = entry
+                insort(self.entries, entry)
+                insort(self.players.setdefault(character.player, []), entry)
+
+    # Get names starting with the prefix, optionally only those owned by a player
+    def search(self, prefix, player=None, limit=max_suggestions):
+        prefix = prefix.lower()
+        names = []
+
+        with self.lock:
+            entries = self.entries if player is None else self.players.get(player, [])
+            index = bisect_left(entries, (prefix,))
+
+            while index < len(entries) and len(names) < limit:
+                lowered, name, _, _ = entries[index]
+
+                if not lowered.startswith(prefix):
+                    break
+
+                names.append(name)
+                index += 1
+
+        return names
@@ -0,0 +1,118 @@
+# Load standard libraries
+import asyncio
+import datetime
+import time
+from collections import OrderedDict
+
+import discord
+
+# Load project files
+import async_database
+import metrics
+
+
+# Resolves discord user ids to names with a bounded TTL/LRU cache in front of the gateway and REST API
+class NameResolver:
+    def __init__(self, bot, max_size=1024, ttl=3600, persist=False, persist_age=86400):
+        self.bot = bot
+        self.max_size = max_size
+        self.ttl = ttl
+        self.persist = persist
+        self.persist_age = persist_age
+        self.cache = OrderedDict()
+        self.fetching = {}
+
+    # Get a cached name if it hasn't expired, marking it as recently used
+    def get_cached(self, user_id):
+        entry = self.cache.get(user_id)
+
+        if not entry:
+            return None
+
+        name, expires = entry
+        if expires < time.monotonic():
+            del self.cache[user_id]
+            return None
+
+        self.cache.move_to_end(user_id)
+        return name
+
+    # Cache a name, evicting the least recently used entries past the size limit
+    def put(self, user_id, name):
+        self.cache[user_id] = (name, time.monotonic() + self.ttl)
+        self.cache.move_to_end(user_id)
+
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+    # Fetch a single user over REST, returning None if discord doesn't know them
+    async def fetch_name(self, user_id):
+        try:
+            user = await metrics.timed_fetch(self.bot.fetch_user(user_id))
+        except discord.HTTPException:
+            return None
+
+        return user.name
+
+    # Fetch users over REST, joining fetches of the same users already in flight for other commands
+    async def fetch_names(self, user_ids):
+        tasks = []
+
+        for user_id in user_ids:
+            if user_id not in self.fetching:
+                self.fetching[user_id] = asyncio.ensure_future(self.fetch_name(user_id))
+                self.fetching[user_id].add_done_callback(lambda _, user_id=user_id: self.fetching.pop(user_id, None))
+
+            tasks.append(asyncio.shield(self.fetching[user_id]))
+
+        return await asyncio.gather(*tasks)
+
+    # Resolve a single user id to a name
+    async def name(self, user_id):
+        return (await self.resolve([user_id]))[user_id]
+
+    # Resolve every distinct user id at once, hitting REST only for ids nobody has seen recently
+    async def resolve(self, user_ids):
+        names = {}
+        missing = []
+
+        for user_id in set(user_ids):
+            name = self.get_cached(user_id)
+
+            if name is None:
+                user = self.bot.get_user(user_id)
+                if user:
+                    name = user.name
+                    self.put(user_id, name)
+
+            if name is None:
+                missing.append(user_id)
+            else:
+                names[user_id] = name
+
+        if missing and self.persist:
+            cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=self.persist_age)
+            stored = await async_database.get_player_names(missing, cutoff)
+
+            for user_id, name in stored.items():
+                self.put(user_id, name)
+                names[user_id] = name
+
+            missing = [user_id for user_id in missing if user_id not in stored]
+
+        if missing:
+            fetched = await self.fetch_names(missing)
+            found = {}
+
+            for user_id, name in zip(missing, fetched):
+                if name is None:
+                    names[user_id] = "Unknown"
+                else:
+                    self.put(user_id, name)
+                    names[user_id] = name
+                    found[user_id] = name
+
+            if found and self.persist:
+                await async_database.save_player_names(found)
+
+        return names
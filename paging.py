@@ -0,0 +1,115 @@
+# Load standard libraries
+import discord
+
+# Longest message discord accepts
+message_limit = 2000
+
+# Pages fetched and rendered together when a window isn't cached yet
+window_pages = 5
+
+
+# Group table lines into parts that fit a code block message together with the title and header
+def split_lines(lines, budget):
+    parts = [[]]
+    size = 0
+
+    for line in lines:
+        line = line[:budget]
+
+        if parts[-1] and size + len(line) > budget:
+            parts.append([])
+            size = 0
+
+        parts[-1].append(line)
+        size += len(line)
+
+    return parts
+
+
+# Table paged with previous/next buttons. Rows are loaded a window of pages at a time through
+# load_window(window index) and the rendered messages are kept for the life of the view.
+class PagedView(discord.ui.View):
+    def __init__(self, load_window, header, pages, page_size, timeout=120):
+        super().__init__(timeout=timeout, disable_on_timeout=True)
+        self.load_window = load_window
+        self.header = header
+        self.pages = pages
+        self.page_size = page_size
+        self.cache = {}
+        self.page = 1
+        self.part = 0
+
+    # Make another view over the same rows, with its own position but sharing the pages already rendered
+    def clone(self):
+        view = PagedView(self.load_window, self.header, self.pages, self.page_size, self.timeout)
+        view.cache = self.cache
+        view.page = self.page
+        view.update_buttons(len(self.cache.get(self.page, [None])))
+        return view
+
+    # Get the rendered messages of a page, loading its window if needed
+    async def render(self, page):
+        if page not in self.cache:
+            window = (page - 1) // window_pages
+            lines = await self.load_window(window)
+            first = window * window_pages + 1
+
+            for offset in range(window_pages):
+                number = first + offset
+                page_lines = lines[offset * self.page_size:(offset + 1) * self.page_size]
+
+                if number == page or page_lines:
+                    self.cache[number] = self.render_page(number, page_lines)
+
+        return self.cache[page]
+
+    # Render one page of lines into one or more messages under the message limit
+    def render_page(self, page, lines):
+        budget = message_limit - len(self.header) - 40
+        parts = split_lines(lines, budget)
+        messages = []
+
+        for index, part in enumerate(parts):
+            title = f"Page {page}/{self.pages}" + (f" ({index + 1}/{len(parts)})" if len(parts) > 1 else "")
+            messages.append(f"```{title}\n{self.header}" + "".join(part) + "```")
+
+        return messages
+
+    # Enable only the buttons that lead somewhere
+    def update_buttons(self, parts):
+        self.previous_button.disabled = self.page <= 1 and self.part == 0
+        self.next_button.disabled = self.page >= self.pages and self.part >= parts - 1
+
+    # Send the first message of the given page
+    async def send(self, ctx, page):
+        self.page = page
+        messages = await self.render(page)
+        self.update_buttons(len(messages))
+        await ctx.respond(messages[0], view=self)
+
+    # Move by one message, crossing into the neighbouring page at either end
+    async def move(self, interaction, step):
+        messages = await self.render(self.page)
+
+        if 0 <= self.part + step < len(messages):
+            self.part += step
+        else:
+            self.page += step
+            messages = await self.render(self.page)
+            self.part = 0 if step > 0 else len(messages) - 1
+
+        self.update_buttons(len(messages))
+        await interaction.response.edit_message(content=messages[self.part], view=self)
+
+    @discord.ui.button(label="Previous", style=discord.ButtonStyle.secondary)
+    async def previous_button(self, button, interaction):
+        await self.move(interaction, -1)
+
+    @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary)
+    async def next_button(self, button, interaction):
+        await self.move(interaction, 1)
+
+    # Drop the cached pages and disable the buttons once the view expires
+    async def on_timeout(self):
+        self.cache.clear()
+        await super().on_timeout()
@@ -0,0 +1,96 @@
+# Load standard libraries
+import threading
+from bisect import bisect_left, insort
+from collections import namedtuple
+
+# A character's place on the leaderboard
+Standing = namedtuple("Standing", ["id", "name", "ap", "rp", "player"])
+
+# The leaderboard orderings, keyed by the currency they sort by
+orderings = ["AP", "RP", None]
+
+
+# Lowercase only ASCII letters, matching SQLite's lower() so the orderings agree with the database
+def sqlite_lower(name):
+    return "".join(letter.lower() if letter.isascii() else letter for letter in name)
+
+
+# Sort key of a standing for an ordering, ending in the id as a tie-breaker
+def sort_key(standing, currency):
+    if currency == "AP":
+        return -standing.ap, sqlite_lower(standing.name), standing.id
+    elif currency == "RP":
+        return -standing.rp, sqlite_lower(standing.name), standing.id
+    else:
+        return sqlite_lower(standing.name), standing.id
+
+
+# In-memory leaderboard with one sorted key list per ordering, updated as characters change
+class RankIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.standings = {}
+        self.names = {}
+        self.keys = {currency: [] for currency in orderings}
+
+    # Replace the whole index with the given characters
+    def load(self, characters):
+        with self.lock:
+            self.standings = {character.id: Standing(character.id, character.name, character.ap, character.rp,
+                                                     character.player) for character in characters}
+            self.names = {standing.name: standing.id for standing in self.standings.values()}
+            self.keys = {currency: sorted(sort_key(standing, currency) for standing in self.standings.values())
+                         for currency in orderings}
+
+    # Take a standing out of every ordering
+    def discard(self, character_id):
+        standing = self.standings.pop(character_id, None)
+
+        if not standing:
+            return
+
+        del self.names[standing.name]
+
+        for currency in orderings:
+            keys = self.keys[currency]
+            index = bisect_left(keys, sort_key(standing, currency))
+            if index < len(keys) and keys[index][-1] == character_id:
+                del keys[index]
+
+    # Apply changed and deleted characters after a commit
+    def update(self, changed, deleted=()):
+        with self.lock:
+            for character_id in deleted:
+                self.discard(character_id)
+
+            for character in changed:
+                self.discard(character.id)
+                standing = Standing(character.id, character.name, character.ap, character.rp, character.player)
+                self.standings[standing.id] = standing
+                self.names[standing.name] = standing.id
+
+                for currency in orderings:
+                    insort(self.keys[currency], sort_key(standing, currency))
+
+    # Number of characters on the leaderboard
+    def count(self):
+        return len(self.standings)
+
+    # Get a page of standings in the given ordering
+    def page(self, currency, page, page_size):
+        if page < 1:
+            return []
+
+        with self.lock:
+            keys = self.keys[currency][page_size * (page - 1):page_size * page]
+            return [self.standings[key[-1]] for key in keys]
+
+    # Get a character's 1-based rank in the given ordering, or None if they don't exist
+    def rank(self, name, currency):
+        with self.lock:
+            character_id = self.names.get(name)
+
+            if character_id is None:
+                return None
+
+            return bisect_left(self.keys[currency], sort_key(self.standings[character_id], currency)) + 1
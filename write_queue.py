@@ -0,0 +1,66 @@
+# Load standard libraries
+import asyncio
+
+# Load project files
+import async_database
+import database
+
+
+# Write-behind queue that gathers ledger writes for a few milliseconds and commits them together.
+# It offers the same write coroutines as async_database, and each caller still gets its own result.
+class WriteQueue:
+    def __init__(self, window_ms=5, max_batch=200):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.queue = None
+        self.worker = None
+
+    # Queue an operation and wait for its result
+    async def submit(self, operation, *arguments):
+        if self.worker is None:
+            self.queue = asyncio.Queue()
+            self.worker = asyncio.get_running_loop().create_task(self.run())
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((operation, arguments, future))
+        return await future
+
+    # Apply queued operations batch by batch, in the order they arrived
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            await asyncio.sleep(self.window)
+
+            while not self.queue.empty() and len(batch) < self.max_batch:
+                batch.append(self.queue.get_nowait())
+
+            try:
+                results = await async_database.apply_batch([(operation, arguments)
+                                                            for operation, arguments, _ in batch])
+
+                # If the batch as a whole failed, fall back to one commit per operation so only the bad one fails
+                if results is None:
+                    results = [await getattr(async_database, operation)(*arguments)
+                               for operation, arguments, _ in batch]
+            except Exception as error:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+
+            for (_, _, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def create_character(self, guild_id, name, player):
+        return await self.submit("create_character", guild_id, name, player)
+
+    async def erase_transaction(self, guild_id, transaction_id):
+        return await self.submit("erase_transaction", guild_id, transaction_id)
+
+    async def apply_transaction(self, guild_id, character_name, user, currency, amount, reason):
+        return await self.submit("apply_transaction", guild_id, character_name, user, currency, amount, reason)
+
+    async def do_transaction(self, guild_id, character_name, user, currency, amount, reason):
+        return await self.apply_transaction(guild_id, character_name, user, currency, amount, reason) == \
+            database.TRANSACTION_DONE